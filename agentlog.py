@@ -0,0 +1,125 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""
+ Non-blocking logging for the agent
+
+ Log calls only put the unformatted record into a bounded queue, a background
+ thread formats, redacts and writes them. When the queue is full records are
+ dropped and counted instead of blocking the caller.
+
+ Records may carry these attributes (through `extra=`) for the sink:
+   command  - the agent command, arguments are redacted if it is censored
+   splitter - separator between command name and sensitive data
+   truncate - shorten the first argument to this many characters
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+import stats
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+# `text` or `json`
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # formatting is done by the sink thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            stats.incr('log_dropped')
+
+def censor(data, splitter):
+    data_list = data.split(splitter, maxsplit=1)
+    if len(data_list) == 1:
+        return data
+    return data_list[0] + splitter + '...(censored)'
+
+class RedactFilter(logging.Filter):
+    def __init__(self, censored_commands):
+        super().__init__()
+        self.censored_commands = tuple(censored_commands)
+
+    def filter(self, record):
+        command = getattr(record, 'command', None)
+        if not record.args or not isinstance(record.args, tuple):
+            return True
+
+        args = list(record.args)
+        if command is not None and command.startswith(self.censored_commands):
+            splitter = getattr(record, 'splitter', '=')
+            args = [censor(a, splitter) if isinstance(a, str) else a for a in args]
+
+        limit = getattr(record, 'truncate', None)
+        if limit and isinstance(args[0], str) and len(args[0]) >= limit:
+            args[0] = '%s...(%d bytes)' % (args[0][:limit], len(args[0]) - limit)
+
+        record.args = tuple(args)
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'command', None) is not None:
+            # only the command name, arguments may be sensitive
+            data['command'] = record.command.split('?', 1)[0]
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+listener = None
+
+def setup_logging(censored_commands=(), level=LOG_LEVEL, stream=sys.stdout):
+    global listener
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+
+    sink = logging.StreamHandler(stream)
+    sink.addFilter(RedactFilter(censored_commands))
+    if LOG_FORMAT == 'json':
+        sink.setFormatter(JsonFormatter())
+    else:
+        sink.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(DroppingQueueHandler(log_queue))
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, sink)
+    listener.start()
+    atexit.register(listener.stop)
+
+    stats.register('log', lambda: {'queued': log_queue.qsize(),
+                                   'capacity': LOG_QUEUE_SIZE})
@@ -14,30 +14,46 @@
 # along with twnhi-smartcard-agent.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import logging
 import os
-import socket
+import threading
+import time
 
-from hexdump import hexdump
-
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import padding, rsa
-
-from cryptos import DES3, pkcs5_pad, pkcs5_unpad, L_KEY
+import netutil
+import stats
+import tracing
+from cryptos import des3_new, pkcs5_pad, pkcs5_unpad, L_KEY
 from errors import ServiceError
 
 DEBUG = bool(os.getenv('DEBUG_MODE', None))
 
+logger = logging.getLogger('sam')
+
 DEFAULT_HOST = os.getenv('NIC_SMARTCARD_AUTH_HOST', 'cloudicap.nhi.gov.tw')
-DEFAULT_PORT = int(os.getenv('NIC_SMARTCARD_AUTH_HOST', 443))
+DEFAULT_PORT = int(os.getenv('NIC_SMARTCARD_AUTH_PORT', 443))
+
+# send / recv failures of a signing exchange, a reused session which fails
+# with one of these was most likely closed by the service
+SESSION_ERROR_CODES = (8003, 8005, 8007, 8008)
+
+# open and authenticate a SAM session ahead of the first signature when a
+# signing page is likely (see `warm_up`), unused sessions are closed after
+# SAM_WARM_IDLE seconds
+SAM_WARM_UP = os.getenv('SAM_WARM_UP', '1') == '1'
+SAM_WARM_IDLE = float(os.getenv('SAM_WARM_IDLE', 15))
+# a successful service check is trusted for this many seconds
+SAM_CHECK_TTL = float(os.getenv('SAM_CHECK_TTL', 300))
 
 def recvall(conn, err_code, err_desc):
     data = b''
     while not data.endswith(b'<E>'):
         try:
-            data += conn.recv(4096)
+            chunk = conn.recv(4096)
         except Exception as e:
             raise ServiceError(err_code, err_desc, e)
+        if not chunk:
+            raise ServiceError(err_code, err_desc, ConnectionError('Connection closed'))
+        data += chunk
 
     return data
 
@@ -48,7 +64,7 @@ def send_packet(conn, data, error_code, description):
         raise ServiceError(error_code, description, e)
 
 def encrypt(key, data):
-    cipher = DES3.new(key, DES3.MODE_ECB)
+    cipher = des3_new(key)
     encrypted = cipher.encrypt(pkcs5_pad(data))
     return encrypted + b'<E>'
 
@@ -56,16 +72,26 @@ def decrypt(key, data):
     # funciton `recvall` already ensures that data will end with b'<E>'
     assert data.endswith(b'<E>')
 
-    cipher = DES3.new(key, DES3.MODE_ECB)
+    cipher = des3_new(key)
     decrypted = cipher.decrypt(data[:-3])
     return pkcs5_unpad(decrypted)
 
 def debug_dump(name, data):
     if DEBUG:
+        from hexdump import hexdump
         print('%s:' % name)
         hexdump(data)
 
+def load_crypto_modules():
+    # cryptography takes a while to import, defer it until the first handshake
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+    return default_backend, serialization, padding, rsa
+
+@tracing.traced('sam.handshake')
 def handshake(conn):
+    default_backend, serialization, padding, rsa = load_crypto_modules()
     try:
         # generate rsa key for handshake
         private_key = rsa.generate_private_key(
@@ -123,65 +149,200 @@ def handshake(conn):
 
 def connect(host=DEFAULT_HOST, port=DEFAULT_PORT):
     try:
-        return socket.create_connection((host, port))
+        with tracing.span('sam.connect'):
+            return netutil.create_connection(host, port)
     except Exception as e:
         raise ServiceError(4061, 'Can not connect to host', e)
 
-def sam_hc_auth_check(raise_on_failed=False):
-    with connect() as conn:
+last_check = 0
+
+def sam_hc_auth_check(raise_on_failed=False, max_age=0):
+    """ `max_age` skips the check if one succeeded less than max_age seconds ago """
+    global last_check
+    if max_age > 0 and time.monotonic() - last_check < max_age:
+        stats.incr('sam_check_cached')
+        return True
+
+    with tracing.span('sam.check'), connect() as conn:
         sess_key = handshake(conn)
         send_packet(conn, b'77<E>', 8003, 'Failed to send test packet')
         ret = recvall(conn, 8005, 'Service check failed') == b'04<rc=2>OK<E>'
 
-        if not ret and raise_on_failed:
+        if ret:
+            last_check = time.monotonic()
+        elif raise_on_failed:
             raise ServiceError(8005, 'Service check failed')
         return ret
 
-def sam_hc_auth(client, to_sign):
-    with connect() as conn:
-        sess_key = handshake(conn)
-
-        # prepare data to be signed
-        client.select_applet()
-        hcid = client.get_hc_card_id()
-        rnd = client.get_random()
-
-        # send auth request
-        assert len(hcid) == 12 and len(rnd) == 8
-        data = b'01<id=12>%s<rn=8>%s<E>' % (hcid, rnd)
-        packet = encrypt(sess_key, data)
+class WarmSession:
+    """ At most one authenticated SAM session waiting for a signature """
+    def __init__(self, idle=SAM_WARM_IDLE):
+        self.idle = idle
+        self.lock = threading.Lock()
+        self.session = None
+        self.warming = False
+        # set when this very session is handed out, one per session so a
+        # late take() cannot affect the next warm up
+        self.taken = None
+
+    def warm_up(self, reason):
+        """ Start a session in background unless one is ready or on its way """
+        with self.lock:
+            if self.session is not None or self.warming:
+                return
+            self.warming = True
+        stats.incr('sam_warm_started')
+        threading.Thread(target=self.run, args=(reason, ),
+                         name='sam-warm-up', daemon=True).start()
+
+    def run(self, reason):
+        conn = None
+        try:
+            with tracing.span('sam.warm_up', root=True, reason=reason):
+                sam_hc_auth_check(raise_on_failed=True, max_age=SAM_CHECK_TTL)
+                conn = connect()
+                sess_key = handshake(conn)
+        except Exception as e:
+            if conn is not None:
+                conn.close()
+            stats.incr('sam_warm_failed')
+            logger.info('[-] SAM warm-up failed: %r', e)
+            with self.lock:
+                self.warming = False
+            return
+
+        session = (conn, sess_key)
+        taken = threading.Event()
+        with self.lock:
+            self.session = session
+            self.taken = taken
+            self.warming = False
+
+        if not taken.wait(self.idle):
+            with self.lock:
+                expired = self.session is session
+                if expired:
+                    self.session = self.taken = None
+            if expired:
+                stats.incr('sam_warm_expired')
+                conn.close()
+
+    def take(self):
+        """ Returns (conn, sess_key) of the warm session, or None """
+        with self.lock:
+            session, self.session = self.session, None
+            if session is not None:
+                self.taken.set()
+                self.taken = None
+        if session is None:
+            stats.incr('sam_warm_miss')
+            return None
+        stats.incr('sam_warm_hit')
+        return session
+
+warm_session = WarmSession()
+
+def warm_up(reason):
+    if SAM_WARM_UP:
+        warm_session.warm_up(reason)
+
+def sam_sign(conn, sess_key, client, hcid, to_sign):
+    """ One signing exchange on an established SAM session """
+    rnd = client.get_random()
+
+    # send auth request
+    assert len(hcid) == 12 and len(rnd) == 8
+    data = b'01<id=12>%s<rn=8>%s<E>' % (hcid, rnd)
+    packet = encrypt(sess_key, data)
+    with tracing.span('sam.challenge'):
         send_packet(conn, packet, 8003, 'Failed to send auth request 01')
 
         # recv challenge
         packet = recvall(conn, 8005, 'Failed to recv challenge')
-        data = decrypt(sess_key, packet)
-        debug_dump('Challenge', data)
-        # b'02<au=32>................................<E>'
-        if not (data.startswith(b'02<au=32>') and data.endswith(b'<E>')):
-            raise ServiceError(8005, 'Failed to decrypt challenge')
-        challenge = data[9:9+32]
-
-        # use hccard to sign challenge
-        response = client.muauth_hc_dc_sam(challenge)
-        debug_dump('Response', response)
-        if len(response) != 16:
-            raise ServiceError(8006, 'Invalid data length from SAM signing')
-
-        # send challenge and data to be signed
-        if len(to_sign) != 20:
-            raise ServiceError(8006, 'Invalid data length `to_sign`')
-
-        data = b'03<au=16>%s<se=20>%s<E>' % (response, to_sign)
-        packet = encrypt(sess_key, data)
+    data = decrypt(sess_key, packet)
+    debug_dump('Challenge', data)
+    # b'02<au=32>................................<E>'
+    if not (data.startswith(b'02<au=32>') and data.endswith(b'<E>')):
+        raise ServiceError(8005, 'Failed to decrypt challenge')
+    challenge = data[9:9+32]
+
+    # use hccard to sign challenge
+    response = client.muauth_hc_dc_sam(challenge)
+    debug_dump('Response', response)
+    if len(response) != 16:
+        raise ServiceError(8006, 'Invalid data length from SAM signing')
+
+    # send challenge and data to be signed
+    if len(to_sign) != 20:
+        raise ServiceError(8006, 'Invalid data length `to_sign`')
+
+    data = b'03<au=16>%s<se=20>%s<E>' % (response, to_sign)
+    packet = encrypt(sess_key, data)
+    with tracing.span('sam.signature'):
         send_packet(conn, packet, 8007, 'Failed to send response')
 
         # got signature
         data = decrypt(sess_key, recvall(conn, 8008, 'Failed to recv signature'))
-        debug_dump('Signature', data)
-        # b'04<rc=2>OK<si=256>' ...(256bytes) b'<E>'
-        if not (data.startswith(b'04<rc=2>OK<si=256>') and data.endswith(b'<E>')):
-            raise ServiceError(8008, 'Failed to decrypt signature')
-        return data[18:-3]
+    debug_dump('Signature', data)
+    # b'04<rc=2>OK<si=256>' ...(256bytes) b'<E>'
+    if not (data.startswith(b'04<rc=2>OK<si=256>') and data.endswith(b'<E>')):
+        raise ServiceError(8008, 'Failed to decrypt signature')
+    return data[18:-3]
+
+def sam_hc_auth(client, to_sign):
+    for _, sig, err in sam_hc_auth_batch(client, [to_sign]):
+        if err is not None:
+            raise err
+        return sig
+
+def sam_hc_auth_batch(client, payloads):
+    """
+        Sign many payloads with one handshake and one card session, yields
+        `(index, signature, None)` or `(index, None, error)` as each payload
+        completes. If the service closes a session after a signature (or a
+        warm session expired on its side), the payload is retried once on a
+        new session.
+    """
+    with client.transaction():
+        client.select_applet()
+        hcid = client.get_hc_card_id()
+
+    conn, sess_key = warm_session.take() or (None, None)
+    reused = conn is not None
+    try:
+        for index, to_sign in enumerate(payloads):
+            while True:
+                try:
+                    if conn is None:
+                        conn = connect()
+                        sess_key = handshake(conn)
+                        reused = False
+                    # the random must be consumed by the following muauth,
+                    # others may have selected their applet since the last pair
+                    with client.transaction():
+                        client.select_applet()
+                        sig = sam_sign(conn, sess_key, client, hcid, to_sign)
+                except ServiceError as e:
+                    if conn is not None:
+                        conn.close()
+                        conn = None
+                    if reused and e.error_code in SESSION_ERROR_CODES:
+                        reused = False
+                        continue
+                    yield index, None, e
+                except Exception as e:
+                    # card errors, the session is in an unknown state
+                    if conn is not None:
+                        conn.close()
+                        conn = None
+                    yield index, None, e
+                else:
+                    reused = True
+                    yield index, sig, None
+                break
+    finally:
+        if conn is not None:
+            conn.close()
 
 if __name__ == '__main__':
     sam_hc_auth_check()
@@ -16,8 +16,8 @@
 
 import os
 import datetime
+import functools
 import hashlib
-from Cryptodome.Cipher import DES, DES3
 
 bKEY = b'12345678123456780' * 10
 K_BOX = [
@@ -37,8 +37,32 @@ L_KEY1 = bytes(bKEY[K_BOX1[i]] for i in range(24))
 
 KEY_SUFFIX = b'\x27\x06\x58\x66'
 
-TDesLKey = DES3.new(L_KEY, DES3.MODE_ECB)
-TDesLKey1 = DES3.new(L_KEY1, DES3.MODE_ECB)
+# Cryptodome is imported on first use, it is not needed until the first
+# card command and slows down agent startup
+
+def des_new(key):
+    from Cryptodome.Cipher import DES
+    return DES.new(key, DES.MODE_ECB)
+
+def des3_new(key):
+    from Cryptodome.Cipher import DES3
+    return DES3.new(key, DES3.MODE_ECB)
+
+@functools.lru_cache(maxsize=None)
+def tdes_l_key():
+    return des3_new(L_KEY)
+
+@functools.lru_cache(maxsize=None)
+def tdes_l_key1():
+    return des3_new(L_KEY1)
+
+def __getattr__(name):
+    # `TDesLKey` and `TDesLKey1` used to be module attributes
+    if name == 'TDesLKey':
+        return tdes_l_key()
+    elif name == 'TDesLKey1':
+        return tdes_l_key1()
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
 
 def iv_pad(d):
     def rand_byte():
@@ -74,29 +98,38 @@ def pkcs5_unpad(data):
 def card_encrypt(data, cardid):
     t = datetime.date.today().strftime('%Y%m%d')
     tdeskey = hashlib.sha1((cardid + t).encode('ascii')).digest() + KEY_SUFFIX
-    cipher = DES3.new(tdeskey, DES3.MODE_ECB)
+    cipher = des3_new(tdeskey)
 
     data = cipher.encrypt(pkcs5_pad(data))
-    return TDesLKey1.encrypt(iv_pad(data))
+    return tdes_l_key1().encrypt(iv_pad(data))
 
 def card_decrypt(data, cardid):
     t = datetime.date.today().strftime('%Y%m%d')
     tdeskey = hashlib.sha1((cardid + t).encode('ascii')).digest() + KEY_SUFFIX
-    cipher = DES3.new(tdeskey, DES3.MODE_ECB)
+    cipher = des3_new(tdeskey)
 
-    data = TDesLKey1.decrypt(data)
+    data = tdes_l_key1().decrypt(data)
     data = iv_remove(data)
     data = cipher.decrypt(data)
     return pkcs5_unpad(data)
 
-def basic_encrypt(data):
-    key = datetime.date.today().strftime('%m%d%Y').encode('ascii')
-    cipher = DES.new(key, DES.MODE_ECB)
+def basic_key(date=None):
+    if date is None:
+        date = datetime.date.today()
+    return date.strftime('%m%d%Y').encode('ascii')
+
+@functools.lru_cache(maxsize=64)
+def basic_cipher(key):
+    # ECB mode keeps no state between calls, so one cipher per key can be
+    # shared by every caller
+    return des_new(key)
+
+def basic_encrypt(data, date=None):
+    cipher = basic_cipher(basic_key(date))
     return cipher.encrypt(iv_pad(data))
 
-def basic_decrypt(data):
-    key = datetime.date.today().strftime('%m%d%Y').encode('ascii')
-    cipher = DES.new(key, DES.MODE_ECB)
+def basic_decrypt(data, date=None):
+    cipher = basic_cipher(basic_key(date))
     decrypted = cipher.decrypt(data)
     return iv_remove(decrypted, False)
 
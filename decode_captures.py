@@ -0,0 +1,163 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+#!/usr/bin/env python3
+"""
+ Offline decoder for captured `SecureGetBasicWithParam` responses
+
+ Input is a JSONL or CSV file of (timestamp, hex) records, output is one CSV
+ row per record: the timestamp followed by the decoded basic data fields.
+"""
+
+import argparse
+import collections
+import csv
+import datetime
+import functools
+import json
+import multiprocessing
+import os
+import sys
+from itertools import islice
+
+from cryptos import basic_decrypt
+
+CHUNK_SIZE = 256
+
+@functools.lru_cache(maxsize=4096)
+def capture_date(timestamp):
+    # capture logs usually carry many records per second, cache the parsing
+    # result to avoid re-parsing the same timestamp string over and over
+    try:
+        value = float(timestamp)
+    except ValueError:
+        pass
+    else:
+        return datetime.date.fromtimestamp(value)
+
+    value = datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    if value.tzinfo is not None:
+        # the agent derives the key from its local date
+        value = value.astimezone()
+    return value.date()
+
+def decode_record(timestamp, blob):
+    data = basic_decrypt(bytes.fromhex(blob), capture_date(timestamp))
+    return data.rstrip(b'\0').decode('big5-hkscs')
+
+def decode_chunk(chunk):
+    results = []
+    for lineno, timestamp, blob in chunk:
+        if blob is None:
+            results.append((lineno, timestamp, None, 'invalid record'))
+            continue
+        try:
+            results.append((lineno, timestamp, decode_record(timestamp, blob), None))
+        except Exception as e:
+            results.append((lineno, timestamp, None, '%s: %s' % (type(e).__name__, e)))
+    return results
+
+def read_jsonl(fp, ts_field, hex_field):
+    for lineno, line in enumerate(fp, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+            yield lineno, str(record[ts_field]), record[hex_field]
+        except (ValueError, KeyError, TypeError):
+            yield lineno, '', None
+
+def read_csv(fp, ts_field, hex_field):
+    reader = csv.reader(fp)
+    for lineno, row in enumerate(reader, 1):
+        if not row:
+            continue
+        if lineno == 1 and row[:2] == [ts_field, hex_field]:
+            continue
+        if len(row) < 2:
+            yield lineno, '', None
+            continue
+        yield lineno, row[0], row[1]
+
+def read_records(fp, fmt, ts_field, hex_field):
+    if fmt == 'jsonl':
+        return read_jsonl(fp, ts_field, hex_field)
+    return read_csv(fp, ts_field, hex_field)
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def decode_stream(records, processes=None, chunk_size=CHUNK_SIZE):
+    """
+        Decode records in a process pool and yield results in input order,
+        at most `2 * processes` chunks are in flight at any time
+    """
+    processes = processes or os.cpu_count() or 1
+    with multiprocessing.Pool(processes) as pool:
+        pending = collections.deque()
+        for chunk in chunked(records, chunk_size):
+            pending.append(pool.apply_async(decode_chunk, (chunk, )))
+            if len(pending) >= processes * 2:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+def guess_format(filename):
+    if filename.lower().endswith(('.jsonl', '.json', '.ndjson')):
+        return 'jsonl'
+    return 'csv'
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Decode captured SecureGetBasicWithParam responses')
+    parser.add_argument('input', help='JSONL or CSV file, "-" for stdin')
+    parser.add_argument('-o', '--output', default='-', help='output CSV file')
+    parser.add_argument('-f', '--format', choices=['jsonl', 'csv'],
+                        help='input format, guessed from file extension by default')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='number of worker processes (default: cpu count)')
+    parser.add_argument('--ts-field', default='timestamp')
+    parser.add_argument('--hex-field', default='hex')
+    args = parser.parse_args()
+
+    fmt = args.format or guess_format(args.input)
+    fin = sys.stdin if args.input == '-' else \
+            open(args.input, 'r', encoding='utf-8', newline='')
+    fout = sys.stdout if args.output == '-' else \
+            open(args.output, 'w', encoding='utf-8', newline='')
+
+    decoded = failed = 0
+    with fin, fout:
+        writer = csv.writer(fout)
+        records = read_records(fin, fmt, args.ts_field, args.hex_field)
+        for lineno, timestamp, text, err in decode_stream(records, args.processes):
+            if err:
+                failed += 1
+                print('[-] line %d: %s' % (lineno, err), file=sys.stderr)
+                continue
+            decoded += 1
+            writer.writerow([timestamp] + text.split(','))
+
+    print('[*] %d records decoded, %d failed' % (decoded, failed), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+#!/usr/bin/env python3
+"""
+ Bulk card enrollment
+
+ Every attached reader gets its own thread which waits for a card, reads it
+ once and waits for it to be removed. Records are deduplicated by card id
+ and written to a JSONL or CSV file by a single writer thread.
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+
+from smartcard.Exceptions import CardConnectionException, NoCardException
+from smartcard.System import readers as get_readers
+
+from hccard import HealthInsuranceSmartcardClient, SmartcardException, connect_shared
+
+logger = logging.getLogger('enroll')
+
+POLL_INTERVAL = 0.2
+READER_SCAN_INTERVAL = 2
+STATS_INTERVAL = 30
+
+FIELDS = ['card_id', 'id', 'name', 'birth', 'gender', 'unknown', 'card_data',
+          'reader', 'read_at']
+
+class ReaderStats:
+    def __init__(self):
+        self.cards = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.read_time = 0.0
+        self.started = time.monotonic()
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        avg = self.read_time / self.cards * 1000 if self.cards else 0
+        return '%d cards (%.1f/min), %d duplicates, %d errors, %.0f ms/card' % (
+            self.cards, self.cards * 60 / elapsed, self.duplicates,
+            self.errors, avg)
+
+class RecordWriter(threading.Thread):
+    def __init__(self, fp, fmt):
+        super().__init__(name='enroll-writer', daemon=True)
+        self.fp = fp
+        self.fmt = fmt
+        self.queue = queue.Queue()
+
+    def put(self, record):
+        self.queue.put(record)
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        writer = None
+        if self.fmt == 'csv':
+            writer = csv.DictWriter(self.fp, FIELDS)
+            writer.writeheader()
+
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+
+            if writer:
+                writer.writerow(record)
+            else:
+                self.fp.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+            # flush when we caught up, so the file is usable while running
+            if self.queue.empty():
+                self.fp.flush()
+
+        self.fp.flush()
+
+def read_card(conn):
+    with HealthInsuranceSmartcardClient(conn) as client, client.transaction():
+        client.select_applet()
+        basic, card_data = client.get_basic_and_card_data()
+
+    record = basic._asdict()
+    record['card_data'] = card_data.decode('ascii')
+    return record
+
+class ReaderLoop(threading.Thread):
+    def __init__(self, enrollment, reader):
+        super().__init__(name='enroll-%s' % reader, daemon=True)
+        self.enrollment = enrollment
+        self.reader = reader
+        self.stats = ReaderStats()
+
+    def connect(self):
+        conn = self.reader.createConnection()
+        try:
+            connect_shared(conn)
+        except NoCardException:
+            return None
+        return conn
+
+    def wait_for_card(self):
+        while not self.enrollment.stopped.is_set():
+            try:
+                conn = self.connect()
+            except CardConnectionException:
+                conn = None
+
+            if conn:
+                return conn
+            self.enrollment.stopped.wait(POLL_INTERVAL)
+
+    def wait_for_removal(self):
+        while not self.enrollment.stopped.wait(POLL_INTERVAL):
+            try:
+                conn = self.connect()
+            except CardConnectionException:
+                # reader was unplugged or card is half inserted
+                return
+            if conn is None:
+                return
+            conn.disconnect()
+
+    def run(self):
+        logger.info('Watching reader: %s', self.reader)
+        while not self.enrollment.stopped.is_set():
+            conn = self.wait_for_card()
+            if conn is None:
+                break
+
+            started = time.monotonic()
+            try:
+                record = read_card(conn)
+            except (SmartcardException, CardConnectionException) as e:
+                self.stats.errors += 1
+                logger.error('[%s] Failed to read card: %r', self.reader, e)
+            except Exception:
+                # a malformed card must not end the loop of its reader
+                self.stats.errors += 1
+                logger.exception('[%s] Failed to read card', self.reader)
+            else:
+                self.stats.read_time += time.monotonic() - started
+                record['reader'] = str(self.reader)
+                record['read_at'] = datetime.datetime.now().isoformat()
+                if self.enrollment.submit(record):
+                    self.stats.cards += 1
+                    logger.info('[%s] Card %s enrolled', self.reader, record['card_id'])
+                else:
+                    self.stats.duplicates += 1
+                    logger.info('[%s] Card %s already enrolled', self.reader, record['card_id'])
+
+            self.wait_for_removal()
+
+class Enrollment:
+    def __init__(self, writer):
+        self.writer = writer
+        self.stopped = threading.Event()
+        self.loops = {}
+        self.seen = set()
+        self.seen_lock = threading.Lock()
+
+    def submit(self, record):
+        with self.seen_lock:
+            if record['card_id'] in self.seen:
+                return False
+            self.seen.add(record['card_id'])
+        self.writer.put(record)
+        return True
+
+    def scan_readers(self):
+        for reader in get_readers():
+            name = str(reader)
+            loop = self.loops.get(name)
+            if loop is None or not loop.is_alive():
+                loop = self.loops[name] = ReaderLoop(self, reader)
+                loop.start()
+
+    def report(self):
+        for name, loop in sorted(self.loops.items()):
+            logger.info('[%s] %s', name, loop.stats.summary())
+        logger.info('Total: %d unique cards', len(self.seen))
+
+    def run(self, stats_interval=STATS_INTERVAL):
+        self.writer.start()
+        next_report = time.monotonic() + stats_interval
+        try:
+            while not self.stopped.is_set():
+                self.scan_readers()
+                if time.monotonic() >= next_report:
+                    self.report()
+                    next_report += stats_interval
+                self.stopped.wait(READER_SCAN_INTERVAL)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopped.set()
+            for loop in self.loops.values():
+                loop.join()
+            self.writer.close()
+            self.report()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Read every card inserted into any attached reader')
+    parser.add_argument('-o', '--output', default='-',
+                        help='output file, "-" for stdout')
+    parser.add_argument('-f', '--format', choices=['jsonl', 'csv'], default=None,
+                        help='output format, guessed from file extension by default')
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL,
+                        help='seconds between throughput reports')
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ('csv' if args.output.lower().endswith('.csv') else 'jsonl')
+    fp = sys.stdout if args.output == '-' else \
+            open(args.output, 'w', encoding='utf-8', newline='')
+
+    # hccard logs to stdout, move logs to stderr to keep records clean
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    logging.basicConfig(level='INFO', stream=sys.stderr)
+
+    with fp:
+        Enrollment(RecordWriter(fp, fmt)).run(args.stats_interval)
+
+if __name__ == '__main__':
+    main()
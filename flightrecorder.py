@@ -0,0 +1,109 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""
+ Flight recorder for slow commands
+
+ Listens to finished tracing spans. A command span faster than the
+ threshold costs one comparison. For a slow one, its child spans (lock
+ wait, reader connect, APDUs, SAM stages, send) are collected from the
+ tracing ring into a record, and the last records are kept in memory.
+ Only whitelisted span attributes are kept, so no card data or command
+ arguments end up in a record.
+"""
+
+import collections
+import logging
+import os
+import threading
+import time
+
+import stats
+import tracing
+
+logger = logging.getLogger('flightrecorder')
+
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 1000))
+SLOW_REQUEST_RECORDS = int(os.getenv('SLOW_REQUEST_RECORDS', 64))
+
+SAFE_ATTRS = ('command', 'ins', 'reason', 'error')
+
+def redact(attrs):
+    return {k: v for k, v in attrs.items() if k in SAFE_ATTRS}
+
+def descendants(root, spans):
+    """ Spans below `root`, `spans` are spans of the same trace """
+    parents = {s.span_id: s.parent_id for s in spans}
+    result = []
+    for s in spans:
+        parent = s.parent_id
+        while parent is not None and parent != root.span_id:
+            parent = parents.get(parent)
+        if parent == root.span_id:
+            result.append(s)
+    return result
+
+class FlightRecorder:
+    def __init__(self, threshold_ms=SLOW_REQUEST_MS, size=SLOW_REQUEST_RECORDS):
+        self.threshold = threshold_ms / 1000
+        self.records = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def __call__(self, span):
+        if span.name != 'command' or span.duration < self.threshold:
+            return
+        self.record(span)
+
+    def record(self, command):
+        children = descendants(command, tracing.spans(command.trace_id))
+        stages = []
+        totals = collections.defaultdict(float)
+        for s in sorted(children, key=lambda s: s.start):
+            ms = s.duration * 1000
+            totals[s.name] += ms
+            stages.append({
+                'name': s.name,
+                'offset_ms': round((s.start - command.start) * 1000, 3),
+                'ms': round(ms, 3),
+                'thread': s.thread,
+                'attrs': redact(s.attrs),
+            })
+
+        record = {
+            'trace': command.trace_id,
+            'command': command.attrs.get('command'),
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(command.wall)),
+            'ms': round(command.duration * 1000, 3),
+            'error': command.attrs.get('error'),
+            'totals_ms': {name: round(ms, 3) for name, ms in totals.items()},
+            'stages': stages,
+        }
+        with self.lock:
+            self.records.append(record)
+        stats.incr('slow_requests')
+        logger.warning('[-] Slow command %s: %.0f ms, trace %s',
+                       record['command'], record['ms'], record['trace'])
+
+    def report(self):
+        with self.lock:
+            records = list(self.records)
+        return {'threshold_ms': self.threshold * 1000, 'records': records[::-1]}
+
+recorder = FlightRecorder()
+
+def setup():
+    if tracing.ENABLED and SLOW_REQUEST_MS > 0:
+        tracing.add_listener(recorder)
@@ -15,25 +15,68 @@
 # If not, see <https://www.gnu.org/licenses/>.
 
 #!/usr/bin/env python3
+import contextlib
 import logging
+import os
 import sys
-from collections import namedtuple
 
-from smartcard.System import readers as get_readers
-from smartcard.util import toHexString
+import tracing
 
 logging.basicConfig(level='INFO', stream=sys.stdout)
 logger = logging.getLogger(__name__)
 
+# `shared` lets other applications use the reader between our transactions,
+# `exclusive` keeps it for this process as long as it is connected
+SMARTCARD_SHARE_MODE = os.getenv('SMARTCARD_SHARE_MODE', 'shared')
+
 class SmartcardException(Exception):
     pass
 
 class SmartcardCommandException(SmartcardException):
     def __init__(self, *args):
-        super.__init__(*args)
+        super().__init__(*args)
         self.error_code = None
         self.description = None
 
+def pcsc_handle(conn):
+    # pyscard wraps PCSCCardConnection in decorators
+    while conn is not None and not hasattr(conn, 'hcard'):
+        conn = getattr(conn, 'component', None)
+    return conn.hcard if conn is not None else None
+
+def begin_transaction(conn):
+    """
+        Start a PC/SC transaction, other applications sharing the reader
+        wait until `end_transaction`. Connections without PC/SC handle
+        (simulated cards) are ignored.
+    """
+    if hasattr(conn, 'begin_transaction'):
+        return conn.begin_transaction()
+
+    hcard = pcsc_handle(conn)
+    if hcard is None:
+        return
+
+    from smartcard.scard import SCardBeginTransaction, SCardGetErrorMessage, SCARD_S_SUCCESS
+    hresult = SCardBeginTransaction(hcard)
+    if hresult != SCARD_S_SUCCESS:
+        raise SmartcardException('Failed to begin transaction: %s' %
+                                 SCardGetErrorMessage(hresult))
+
+def end_transaction(conn):
+    if hasattr(conn, 'end_transaction'):
+        return conn.end_transaction()
+
+    hcard = pcsc_handle(conn)
+    if hcard is None:
+        return
+
+    from smartcard.scard import SCardEndTransaction, SCardGetErrorMessage, \
+            SCARD_S_SUCCESS, SCARD_LEAVE_CARD
+    hresult = SCardEndTransaction(hcard, SCARD_LEAVE_CARD)
+    if hresult != SCARD_S_SUCCESS:
+        logger.warning('Failed to end transaction: %s', SCardGetErrorMessage(hresult))
+
 class SmartcardClient:
     def __init__(self, conn=None):
         if conn is None:
@@ -42,6 +85,7 @@ class SmartcardClient:
         if not conn:
             raise SmartcardException('Smartcard connection was not provided')
         self.conn = conn
+        self.transaction_depth = 0
 
     def __enter__(self):
         return self
@@ -51,15 +95,140 @@ class SmartcardClient:
 
     def close(self):
         if self.conn:
+            if self.transaction_depth:
+                self.transaction_depth = 0
+                end_transaction(self.conn)
             self.conn.disconnect()
 
+    def begin_transaction(self):
+        """ Nested transactions join the outer one """
+        if self.transaction_depth == 0:
+            begin_transaction(self.conn)
+        self.transaction_depth += 1
+
+    def end_transaction(self):
+        # close() inside the transaction already ended it
+        if self.transaction_depth:
+            self.transaction_depth -= 1
+            if self.transaction_depth == 0:
+                end_transaction(self.conn)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+            Run a sequence of APDUs without other applications interleaving
+            their commands
+        """
+        self.begin_transaction()
+        try:
+            yield self
+        finally:
+            self.end_transaction()
+
     def fire(self, cmd):
-        data, a, b = self.conn.transmit(cmd)
+        with tracing.span('apdu', ins='%02X' % cmd[1]):
+            data, a, b = self.conn.transmit(cmd)
         if (a, b) != (0x90, 0x00):
             raise SmartcardCommandException(data, (a, b))
         return bytes(data)
 
-HCBasicData = namedtuple('HCBaseData', ['card_id', 'id', 'name', 'birth', 'gender', 'unknown'])
+    def fire_many(self, cmds, errors=None):
+        """
+            Independent APDUs in one round trip when the connection pipelines
+            them (remote readers), one by one otherwise. `errors` holds the
+            (error_code, description) of each APDU, like `error_info` sets
+            them for single commands.
+        """
+        transmit_many = getattr(self.conn, 'transmit_many', None)
+        with tracing.span('apdu', ins=','.join('%02X' % cmd[1] for cmd in cmds)):
+            if transmit_many is not None:
+                results = transmit_many(cmds)
+            else:
+                results = [self.conn.transmit(cmd) for cmd in cmds]
+        for index, (data, a, b) in enumerate(results):
+            if (a, b) != (0x90, 0x00):
+                e = SmartcardCommandException(data, (a, b))
+                if errors is not None:
+                    e.error_code, e.description = errors[index]
+                raise e
+        return [bytes(data) for data, _, _ in results]
+
+def _ascii_field(start, end=None):
+    return property(lambda self: str(self._raw[start:end], 'ascii'))
+
+class HCBasicRecord:
+    """
+        Basic data record of the card, a view over the response bytes which
+        decodes the fields on access. Reads like the namedtuple it replaced:
+        attributes, indexing, iteration and `_asdict`.
+
+        Layout: card_id[0:12] name[12:32] (big5-hkscs, NUL padded)
+                id[32:42] birth[42:49] gender[49:50] unknown[50:]
+    """
+    __slots__ = ('_raw',)
+
+    _fields = ('card_id', 'id', 'name', 'birth', 'gender', 'unknown')
+
+    def __init__(self, data):
+        self._raw = memoryview(data)
+
+    card_id = _ascii_field(0, 12)
+    id = _ascii_field(32, 42)
+    birth = _ascii_field(42, 49)
+    gender = _ascii_field(49, 50)
+    unknown = _ascii_field(50)
+
+    def _name_bytes(self):
+        end = 32
+        while end > 12 and self._raw[end - 1] == 0:
+            end -= 1
+        return self._raw[12:end]
+
+    @property
+    def name(self):
+        return str(self._name_bytes(), 'big5-hkscs')
+
+    def __iter__(self):
+        return (getattr(self, field) for field in self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(getattr(self, field) for field in self._fields[index])
+        return getattr(self, self._fields[index])
+
+    def __eq__(self, other):
+        if isinstance(other, HCBasicRecord):
+            return self._raw == other._raw
+        return tuple(self) == other
+
+    def __hash__(self):
+        return hash(self._raw)
+
+    def __repr__(self):
+        return 'HCBaseData(%s)' % ', '.join(
+                '%s=%r' % (field, value) for field, value in zip(self._fields, self))
+
+    def _asdict(self):
+        return dict(zip(self._fields, self))
+
+    def tobytes(self):
+        return self._raw.tobytes()
+
+    def to_wire(self, card_data=b''):
+        """
+            `GetBasic` response body in big5-hkscs, the fields are copied from
+            the card response without decoding:
+            card_id,id,name,birth,gender,<first byte of card data>
+        """
+        raw = self._raw
+        return b','.join((raw[0:12], raw[32:42], self._name_bytes(),
+                          raw[42:49], raw[49:50], card_data[:1]))
+
+# compatibility name
+HCBasicData = HCBasicRecord
 
 def error_info(error_code, description):
     def error_wrapper(f):
@@ -94,21 +263,25 @@ class HealthInsuranceSmartcardClient(SmartcardClient):
     @error_info(8011, 'Failed to get basic data')
     def get_basic(self):
         logger.debug('get basic data')
-        data = self.fire([0, 0xca, 0x11, 0, 2, 0, 0, 0])
-        return HCBasicData(
-            data[:12].decode('ascii'),
-            data[32:42].decode('ascii'),
-            data[12:32].rstrip(b'\0').decode('big5-hkscs'),
-            data[42:49].decode('ascii'),
-            data[49:50].decode('ascii'),
-            data[50:].decode('ascii'),
-        )
+        return HCBasicRecord(self.fire([0, 0xca, 0x11, 0, 2, 0, 0, 0]))
 
     @error_info(8010, 'Failed to get card data')
     def get_hc_card_data(self):
         logger.debug('get HC card data')
         return self.fire([0, 0xca, 0x24, 0, 2, 0, 0, 0])
 
+    def get_basic_and_card_data(self):
+        """ get_basic() and get_hc_card_data() in one round trip if possible """
+        logger.debug('get basic and HC card data')
+        basic, card_data = self.fire_many([
+            [0, 0xca, 0x11, 0, 2, 0, 0, 0],
+            [0, 0xca, 0x24, 0, 2, 0, 0, 0],
+        ], errors=[
+            (8011, 'Failed to get basic data'),
+            (8010, 'Failed to get card data'),
+        ])
+        return HCBasicRecord(basic), card_data
+
     @error_info(8001, 'Failed to get card id')
     def get_hc_card_id(self):
         logger.debug('get HC card id')
@@ -133,6 +306,8 @@ class HealthInsuranceSmartcardClient(SmartcardClient):
         return self.fire(payload)
 
 def select_reader_and_connect(interactive=False):
+    # pyscard is imported on first use to keep agent startup fast
+    from smartcard.System import readers as get_readers
     readers = get_readers()
 
     if not readers:
@@ -153,10 +328,24 @@ def select_reader_and_connect(interactive=False):
         reader = readers[idx]
 
     conn = reader.createConnection()
-    conn.connect()
+    connect_shared(conn)
     return conn
 
+def connect_shared(conn):
+    """ Connect with the sharing mode configured by SMARTCARD_SHARE_MODE """
+    from smartcard.scard import SCARD_SHARE_SHARED, SCARD_SHARE_EXCLUSIVE
+    modes = {'shared': SCARD_SHARE_SHARED, 'exclusive': SCARD_SHARE_EXCLUSIVE}
+    mode = modes.get(SMARTCARD_SHARE_MODE.lower())
+    if mode is None:
+        raise SmartcardException('Invalid SMARTCARD_SHARE_MODE: %r' % SMARTCARD_SHARE_MODE)
+    conn.connect(mode=mode)
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['--batch']:
+        import enroll
+        enroll.main(sys.argv[2:])
+        sys.exit(0)
+
     try:
         conn = select_reader_and_connect(True)
         if not conn:
@@ -165,6 +354,6 @@ if __name__ == '__main__':
         logger.exception('Can not connect to reader, error: %r', e)
         sys.exit(1)
 
-    with HealthInsuranceSmartcardClient(conn) as client:
+    with HealthInsuranceSmartcardClient(conn) as client, client.transaction():
         client.select_applet()
         print(client.get_basic())
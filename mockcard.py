@@ -0,0 +1,79 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""
+ Simulated health insurance card with a pyscard like connection interface,
+ for testing without a reader. The data is made up.
+"""
+
+import os
+
+CARD_ID = b'000012345678'
+BASIC_DATA = CARD_ID + '測試卡'.encode('big5-hkscs').ljust(20, b'\0') + \
+        b'A123456789' + b'0900101' + b'M' + b'1090101'
+CARD_DATA = b'1' + b'\0' * 31
+
+SW_OK = (0x90, 0x00)
+SW_NOT_FOUND = (0x6A, 0x82)
+SW_NOT_SUPPORTED = (0x6D, 0x00)
+
+def reply(data, sw=SW_OK):
+    return data, sw[0], sw[1]
+
+class MockCardConnection:
+    def __init__(self, name='Mock Reader 0'):
+        self.name = name
+        self.connected = False
+        self.selected = False
+
+    def __repr__(self):
+        return '<MockCardConnection %s>' % self.name
+
+    def connect(self, *args, **kwargs):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+        self.selected = False
+
+    def getReader(self):
+        return self.name
+
+    def transmit(self, apdu):
+        cla, ins, p1 = apdu[0], apdu[1], apdu[2]
+
+        if ins == 0xA4:
+            # both the default and the SAM applet
+            self.selected = True
+            return reply([], SW_OK)
+        if not self.selected:
+            return reply([], SW_NOT_FOUND)
+
+        if ins == 0xCA:
+            data = {0x11: BASIC_DATA, 0x24: CARD_DATA, 0x00: CARD_ID}.get(p1)
+            if data is None:
+                return reply([], SW_NOT_FOUND)
+            return reply(list(data), SW_OK)
+        elif ins == 0x84:
+            return reply(list(os.urandom(8)), SW_OK)
+        elif ins == 0x82:
+            return reply(list(os.urandom(16)), SW_OK)
+        return reply([], SW_NOT_SUPPORTED)
+
+def connect(name='Mock Reader 0'):
+    conn = MockCardConnection(name)
+    conn.connect()
+    return conn
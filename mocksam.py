@@ -0,0 +1,167 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+#!/usr/bin/env python3
+"""
+ Simulated SAM signing service, speaks the protocol of
+ complicated_sam_hc_auth.py: hello with RSA nonce exchange, service check
+ (77) and signing (01 -> 02 challenge, 03 -> 04 signature). Signatures are
+ made up, use it with mockcard.py for testing.
+
+   NIC_SMARTCARD_AUTH_HOST=127.0.0.1 NIC_SMARTCARD_AUTH_PORT=18443 python3 server.py
+"""
+
+import argparse
+import logging
+import os
+import socket
+import sys
+import threading
+
+from complicated_sam_hc_auth import encrypt, decrypt, load_crypto_modules
+from cryptos import L_KEY
+
+logger = logging.getLogger('mocksam')
+
+DEFAULT_PORT = 18443
+CHECK_PACKET = b'77<E>'
+# 3DES encrypted 01 and 03 packets including the <E> terminator
+AUTH_REQUEST_SIZE = 43
+SIGN_REQUEST_SIZE = 59
+
+class Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = b''
+
+    def fill(self, size):
+        while len(self.buf) < size:
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise EOFError
+            self.buf += chunk
+
+    def read(self, size):
+        self.fill(size)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def read_packet(self):
+        while b'<E>' not in self.buf:
+            self.fill(len(self.buf) + 1)
+        data, _, self.buf = self.buf.partition(b'<E>')
+        return data + b'<E>'
+
+class MockSamServer:
+    def __init__(self, addr='127.0.0.1', port=DEFAULT_PORT, close_after=None):
+        """ `close_after` closes sessions after that many signatures """
+        self.addr = addr
+        self.port = port
+        self.close_after = close_after
+        default_backend, self.serialization, self.padding, rsa = load_crypto_modules()
+        self.backend = default_backend()
+        self.key = rsa.generate_private_key(
+                public_exponent=65537, key_size=1024, backend=self.backend)
+        self.pem = self.key.public_key().public_bytes(
+                encoding=self.serialization.Encoding.PEM,
+                format=self.serialization.PublicFormat.SubjectPublicKeyInfo).rstrip(b'\n')
+        self.listener = None
+
+    def handshake(self, conn):
+        hello = decrypt(L_KEY, conn.read_packet())
+        if hello[:5] != b'Hello':
+            raise EOFError
+        client_key = self.serialization.load_pem_public_key(hello[6:], backend=self.backend)
+
+        nonce = os.urandom(16)
+        enc_nonce = client_key.encrypt(nonce, self.padding.PKCS1v15())
+        conn.sock.sendall(encrypt(L_KEY, (b'Hello ' + self.pem).ljust(0x11b, b' ') + enc_nonce))
+
+        # b' <length> <encrypted nonce><E>'
+        while conn.buf.count(b' ') < 2:
+            conn.fill(len(conn.buf) + 1)
+        _, size, conn.buf = conn.buf.split(b' ', 2)
+        remote_nonce = self.key.decrypt(conn.read(int(size)), self.padding.PKCS1v15())
+        conn.read(3)
+        return (remote_nonce + nonce)[:24]
+
+    def serve(self, sock):
+        conn = Connection(sock)
+        try:
+            sess_key = self.handshake(conn)
+            signed = 0
+            while True:
+                conn.fill(len(CHECK_PACKET))
+                if conn.buf.startswith(CHECK_PACKET):
+                    conn.read(len(CHECK_PACKET))
+                    sock.sendall(b'04<rc=2>OK<E>')
+                    return
+
+                request = decrypt(sess_key, conn.read(AUTH_REQUEST_SIZE))
+                if not request.startswith(b'01<id=12>'):
+                    return
+                sock.sendall(encrypt(sess_key, b'02<au=32>' + os.urandom(16).hex().encode() + b'<E>'))
+
+                request = decrypt(sess_key, conn.read(SIGN_REQUEST_SIZE))
+                if not request.startswith(b'03<au=16>'):
+                    return
+                signature = os.urandom(128).hex().upper().encode()
+                sock.sendall(encrypt(sess_key, b'04<rc=2>OK<si=256>' + signature + b'<E>'))
+
+                signed += 1
+                if self.close_after and signed >= self.close_after:
+                    return
+        except (EOFError, OSError, ValueError):
+            pass
+        finally:
+            sock.close()
+
+    def bind(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.addr, self.port))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        logger.info('[+] Mock SAM server bind on %s:%d', self.addr, self.port)
+
+    def serve_forever(self):
+        if self.listener is None:
+            self.bind()
+        while True:
+            sock, _ = self.listener.accept()
+            threading.Thread(target=self.serve, args=(sock, ),
+                             name='mocksam', daemon=True).start()
+
+    def start(self):
+        """ Serve in a background thread, returns the bound port """
+        self.bind()
+        threading.Thread(target=self.serve_forever, name='mocksam-accept',
+                         daemon=True).start()
+        return self.port
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated SAM signing service')
+    parser.add_argument('--bind', default='127.0.0.1:%d' % DEFAULT_PORT)
+    parser.add_argument('--close-after', type=int, default=None,
+                        help='close sessions after this many signatures')
+    args = parser.parse_args()
+
+    logging.basicConfig(level='INFO', stream=sys.stdout)
+    addr, _, port = args.bind.rpartition(':')
+    MockSamServer(addr, int(port), args.close_after).serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""
+ Outgoing connections: in-process DNS cache and happy eyeballs connect
+
+ getaddrinfo does not tell us the record TTL, so answers are kept for a
+ fixed DNS_CACHE_TTL and failures for DNS_NEGATIVE_TTL seconds.
+"""
+
+import errno
+import os
+import select
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+import stats
+
+DNS_CACHE_TTL = int(os.getenv('DNS_CACHE_TTL', 60))
+DNS_NEGATIVE_TTL = int(os.getenv('DNS_NEGATIVE_TTL', 10))
+DNS_CACHE_SIZE = 1024
+# "Connection Attempt Delay" recommended by RFC 8305
+CONNECT_ATTEMPT_DELAY = 0.25
+
+CONNECT_IN_PROGRESS = {0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN,
+                       getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK)}
+
+class DNSCache:
+    def __init__(self, ttl=DNS_CACHE_TTL, negative_ttl=DNS_NEGATIVE_TTL,
+                 maxsize=DNS_CACHE_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def lookup(self, host):
+        """ Returns [(family, sockaddr without port), ...] """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(host)
+            if entry and entry[0] > now:
+                self.entries.move_to_end(host)
+                expire, addrs, err = entry
+                if err:
+                    stats.incr('dns_cache_negative_hit')
+                    raise err
+                stats.incr('dns_cache_hit')
+                return addrs
+
+        stats.incr('dns_cache_miss')
+        try:
+            infos = socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            self.store(host, None, e, self.negative_ttl)
+            raise
+
+        addrs = []
+        for family, _, _, _, sockaddr in infos:
+            if (family, sockaddr[0]) not in addrs:
+                addrs.append((family, sockaddr[0]))
+        self.store(host, addrs, None, self.ttl)
+        return addrs
+
+    def store(self, host, addrs, err, ttl):
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.entries[host] = (time.monotonic() + ttl, addrs, err)
+            self.entries.move_to_end(host)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+dns_cache = DNSCache()
+
+def interleave(addrs):
+    """ Alternate address families, starting with the first one (RFC 8305) """
+    if not addrs:
+        return []
+    first = [a for a in addrs if a[0] == addrs[0][0]]
+    other = [a for a in addrs if a[0] != addrs[0][0]]
+    result = []
+    for i in range(max(len(first), len(other))):
+        result.extend(group[i] for group in (first, other) if i < len(group))
+    return result
+
+def create_connection(host, port, timeout=None, setup=None, resolver=dns_cache):
+    """
+        Connect to (host, port), racing the resolved addresses: a new attempt
+        starts every CONNECT_ATTEMPT_DELAY seconds or as soon as the previous
+        one failed, the first established connection wins.
+        `setup(sock)` is called on every socket before connecting.
+    """
+    addrs = interleave(resolver.lookup(host))
+    deadline = time.monotonic() + timeout if timeout else None
+    pending = {}
+    last_error = None
+    winner = None
+    next_attempt = 0
+
+    try:
+        while winner is None:
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise socket.timeout('Connect to %s:%d timed out' % (host, port))
+
+            if addrs and (not pending or now >= next_attempt):
+                family, address = addrs.pop(0)
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                try:
+                    if setup:
+                        setup(sock)
+                    sock.setblocking(False)
+                    err = sock.connect_ex((address, port))
+                except OSError as e:
+                    sock.close()
+                    last_error = e
+                    continue
+
+                if err == 0:
+                    winner = sock
+                    break
+                elif err in CONNECT_IN_PROGRESS:
+                    pending[sock] = address
+                    next_attempt = now + CONNECT_ATTEMPT_DELAY
+                else:
+                    sock.close()
+                    last_error = OSError(err, os.strerror(err))
+                continue
+
+            if not pending:
+                raise last_error or OSError('No address to connect for %s' % host)
+
+            wait = None
+            if addrs:
+                wait = max(next_attempt - now, 0)
+            if deadline is not None:
+                wait = deadline - now if wait is None else min(wait, deadline - now)
+
+            # Windows reports failed connects in the exception list
+            socks = list(pending)
+            _, writable, failed = select.select([], socks, socks, wait)
+            for sock in set(writable) | set(failed):
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0 and winner is None:
+                    winner = sock
+                else:
+                    if err:
+                        last_error = OSError(err, os.strerror(err))
+                    sock.close()
+                    # start the next attempt right away
+                    next_attempt = 0
+                del pending[sock]
+    finally:
+        for sock in pending:
+            sock.close()
+
+    winner.setblocking(True)
+    winner.settimeout(timeout)
+    return winner
@@ -0,0 +1,117 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""
+ Sampling profiler
+
+ Samples the stacks of every thread with `sys._current_frames` and outputs
+ collapsed stacks ("root;caller;callee count" per line), which flamegraph.pl
+ and speedscope read directly. The first frame of every stack is the
+ thread group (the thread name without its number), e.g. `socks`,
+ `forwarder`, `command`, `sam-warm-up`, so samples are attributed to the
+ subsystem which owns the thread.
+
+ Only native code releasing the GIL shows up as the Python line calling
+ it, e.g. RSA key generation appears as `sam.handshake` frames.
+"""
+
+import collections
+import logging
+import os
+import re
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+import stats
+
+logger = logging.getLogger('profiler')
+
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.01))
+PROFILE_SECONDS = 10
+PROFILE_MAX_SECONDS = 60
+PROFILE_DIR = os.getenv('PROFILE_DIR', tempfile.gettempdir())
+
+_running = threading.Lock()
+
+def thread_group(name):
+    return re.sub(r'[-_ ]?\d+$', '', name) or name
+
+def frame_label(frame):
+    return '%s:%s' % (frame.f_globals.get('__name__', '?'), frame.f_code.co_name)
+
+def collapse(frame):
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+def sample(seconds, interval=PROFILE_INTERVAL):
+    """ Returns a Counter of collapsed stacks sampled for `seconds` """
+    me = threading.get_ident()
+    counts = collections.Counter()
+    deadline = time.monotonic() + seconds
+    samples = 0
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            group = thread_group(names.get(ident, 'unknown'))
+            counts[';'.join([group] + collapse(frame))] += 1
+        samples += 1
+        time.sleep(interval)
+    stats.incr('profile_samples', samples)
+    return counts
+
+def format_collapsed(counts):
+    return ''.join('%s %d\n' % (stack, count) for stack, count in counts.most_common())
+
+def profile(seconds=PROFILE_SECONDS):
+    """ Collapsed stacks as text, None if another profile is running """
+    seconds = max(0.1, min(float(seconds), PROFILE_MAX_SECONDS))
+    if not _running.acquire(blocking=False):
+        return None
+    try:
+        logger.info('[*] Profiling for %.1f seconds', seconds)
+        stats.incr('profiles_taken')
+        return format_collapsed(sample(seconds))
+    finally:
+        _running.release()
+
+def profile_to_file(seconds=PROFILE_SECONDS):
+    result = profile(seconds)
+    if result is None:
+        logger.info('[-] A profile is already running')
+        return
+    path = os.path.join(PROFILE_DIR, 'agent-%d-%s.folded' % (
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(result)
+    logger.info('[+] Profile written to %s', path)
+
+def install_signal_handler():
+    """ SIGUSR2 writes a PROFILE_SECONDS profile to PROFILE_DIR, not on Windows """
+    if not hasattr(signal, 'SIGUSR2'):
+        return
+
+    def handler(signum, frame):
+        threading.Thread(target=profile_to_file, name='profiler', daemon=True).start()
+    signal.signal(signal.SIGUSR2, handler)
@@ -0,0 +1,209 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""
+ Extra SOCKS5 acceptor processes sharing the proxy port with SO_REUSEPORT
+
+ The smartcard belongs to the main process, workers relay hijacked
+ connections to the wss listener of the main process on loopback. Workers
+ report their counters with a heartbeat, the supervisor restarts workers
+ which died or stopped sending heartbeats, backing off exponentially when
+ a worker keeps failing and giving up on it after `MAX_FAILURES` in a row.
+"""
+
+import functools
+import logging
+import multiprocessing
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+
+import netutil
+import pysoxy
+import stats
+import traffic
+
+logger = logging.getLogger('proxy_workers')
+
+HEARTBEAT_INTERVAL = 2
+HEALTH_TIMEOUT = 15
+# restart delays double from RESTART_BACKOFF up to RESTART_BACKOFF_MAX, a
+# worker running for STABLE_TIME resets its count of consecutive failures
+RESTART_BACKOFF = 1
+RESTART_BACKOFF_MAX = 60
+STABLE_TIME = 60
+MAX_FAILURES = 10
+
+def reuse_port_supported():
+    return hasattr(socket, 'SO_REUSEPORT')
+
+def relay_to_owner(owner, wrapper):
+    """ Hijacker of worker processes, pass TLS bytes to the main process """
+    try:
+        owner = netutil.create_connection(owner[0], owner[1], pysoxy.TIMEOUT_SOCKET)
+    except socket.error as err:
+        pysoxy.error('Failed to connect to the agent', err)
+        return
+
+    stats.incr('hijack_relayed')
+    try:
+        pysoxy.proxy_loop(wrapper, owner)
+    finally:
+        owner.close()
+
+def heartbeat(index, status_queue):
+    while True:
+        try:
+            status_queue.put_nowait((index, os.getpid(), stats.snapshot()))
+        except queue.Full:
+            pass
+        time.sleep(HEARTBEAT_INTERVAL)
+
+def worker_main(index, owner, host, status_queue):
+    logging.basicConfig(level='INFO', stream=sys.stdout)
+    threading.Thread(target=heartbeat, args=(index, status_queue),
+                     name='heartbeat', daemon=True).start()
+
+    logger.info('[*] Proxy worker %d relays hijacked connections to %s:%d',
+                index, owner[0], owner[1])
+    pysoxy.REUSE_PORT = True
+    pysoxy.main(functools.partial(relay_to_owner, owner), host)
+
+class WorkerSupervisor:
+    def __init__(self, count, owner, host):
+        # spawn instead of fork, the main process already runs threads
+        self.context = multiprocessing.get_context('spawn')
+        self.count = count
+        self.owner = owner
+        self.host = host
+        self.status_queue = self.context.Queue(count * 16)
+        self.workers = {}
+        self.last_seen = {}
+        self.snapshots = {}
+        self.restarts = {}
+        # consecutive failures, and when the pending restarts are due
+        self.failures = {}
+        self.started = {}
+        self.restart_at = {}
+        self.given_up = set()
+        self.lock = threading.Lock()
+
+    def spawn(self, index):
+        proc = self.context.Process(
+                target=worker_main, name='proxy-worker-%d' % index,
+                args=(index, self.owner, self.host, self.status_queue),
+                daemon=True)
+        proc.start()
+        logger.info('[+] Proxy worker %d started, pid = %d', index, proc.pid)
+        self.workers[index] = proc
+        # give the interpreter some time to start up
+        self.last_seen[index] = self.started[index] = time.monotonic()
+
+    def start(self):
+        for index in range(self.count):
+            self.restarts[index] = 0
+            self.failures[index] = 0
+            self.spawn(index)
+        threading.Thread(target=self.supervise, name='proxy-supervisor',
+                         daemon=True).start()
+
+    def collect(self):
+        while True:
+            try:
+                index, pid, snapshot = self.status_queue.get_nowait()
+            except queue.Empty:
+                return
+            with self.lock:
+                if index in self.workers and self.workers[index].pid == pid:
+                    self.last_seen[index] = time.monotonic()
+                    self.snapshots[index] = snapshot
+
+    def check(self):
+        now = time.monotonic()
+        for index, proc in list(self.workers.items()):
+            if index in self.given_up:
+                continue
+            if index in self.restart_at:
+                if now >= self.restart_at[index]:
+                    del self.restart_at[index]
+                    with self.lock:
+                        self.restarts[index] += 1
+                    stats.incr('proxy_worker_restarts')
+                    self.spawn(index)
+                continue
+            if proc.is_alive() and now - self.last_seen[index] < HEALTH_TIMEOUT:
+                if self.failures[index] and now - self.started[index] >= STABLE_TIME:
+                    self.failures[index] = 0
+                continue
+
+            if proc.is_alive():
+                proc.terminate()
+            proc.join(1)
+            with self.lock:
+                self.snapshots.pop(index, None)
+                self.failures[index] += 1
+                failures = self.failures[index]
+
+            if failures >= MAX_FAILURES:
+                logger.critical('[-] Proxy worker %d (pid %d) failed %d times in a row, '
+                                'not restarting it anymore', index, proc.pid, failures)
+                stats.incr('proxy_worker_given_up')
+                self.given_up.add(index)
+                continue
+
+            delay = min(RESTART_BACKOFF * 2 ** (failures - 1), RESTART_BACKOFF_MAX)
+            logger.error('[-] Proxy worker %d (pid %d) is unhealthy, restart it in %ds',
+                         index, proc.pid, delay)
+            self.restart_at[index] = now + delay
+
+    def supervise(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL / 2)
+            self.collect()
+            self.check()
+
+    def report(self):
+        now = time.monotonic()
+        workers = []
+        total = {}
+        tops = []
+        with self.lock:
+            for index, proc in sorted(self.workers.items()):
+                workers.append({
+                    'index': index,
+                    'pid': proc.pid,
+                    'alive': proc.is_alive(),
+                    'restarts': self.restarts[index],
+                    'failures': self.failures[index],
+                    'given_up': index in self.given_up,
+                    'last_heartbeat': round(now - self.last_seen[index], 1),
+                })
+                snapshot = self.snapshots.get(index, {})
+                for name, value in snapshot.items():
+                    if isinstance(value, (int, float)):
+                        total[name] = total.get(name, 0) + value
+                tops.append(snapshot.get('traffic', []))
+        return {'workers': workers, 'total': total, 'traffic': traffic.merge(*tops)}
+
+def start_workers(count, owner, host):
+    """ `owner` is the (address, port) of the wss listener of this process """
+    supervisor = WorkerSupervisor(count, owner, host)
+    supervisor.start()
+    stats.register('proxy_workers', supervisor.report)
+    return supervisor
@@ -21,16 +21,25 @@
 """
 
 # Network
+import os
 import socket
 import select
+from functools import partial
 from struct import pack, unpack
 # System
-import traceback
+import logging
+import netutil
+import stats
+import timerwheel
+import tracing
+import traffic
 from threading import Thread, activeCount
 from signal import signal, SIGINT, SIGTERM
-from time import sleep
+from time import monotonic, sleep
 import sys
 
+logger = logging.getLogger('pysoxy')
+
 hijacker = None
 hijacked_host = None
 
@@ -39,7 +48,11 @@ hijacked_host = None
 #
 MAX_THREADS = 200
 BUFSIZE = 2048
+# deadline for the SOCKS handshake, and timeout of outgoing connects
 TIMEOUT_SOCKET = 5
+# tunnels without traffic in either direction are closed after this many
+# seconds, 0 keeps them until one side closes
+IDLE_TIMEOUT = int(os.getenv('TUNNEL_IDLE_TIMEOUT', 300))
 LOCAL_ADDR = '127.0.0.1'
 LOCAL_PORT = 17777
 # Parameter to bind a socket to a device, using SO_BINDTODEVICE
@@ -48,6 +61,13 @@ LOCAL_PORT = 17777
 # a routing decision is made
 # OUTGOING_INTERFACE = "eth0"
 OUTGOING_INTERFACE = ""
+# Proxy auto-config file served on the proxy port over plain HTTP, browsers
+# configured with http://LOCAL_ADDR:LOCAL_PORT/proxy.pac only send the
+# hijacked host through the proxy
+PAC_PATH = '/proxy.pac'
+# Share LOCAL_PORT with other processes, see proxy_workers.py
+REUSE_PORT = False
+MAX_HTTP_HEADER = 8192
 
 #
 # Constants
@@ -68,6 +88,8 @@ CMD_CONNECT = b'\x01'
 ATYP_IPV4 = b'\x01'
 # DOMAINNAME '03'
 ATYP_DOMAINNAME = b'\x03'
+# IP V6 address '04'
+ATYP_IPV6 = b'\x04'
 
 
 class ExitStatus:
@@ -85,41 +107,65 @@ class ExitStatus:
 
 
 def error(msg="", err=None):
-    """ Print exception stack trace python """
+    """ Log exception stack trace python """
     if msg:
-        traceback.print_exc()
-        print("[-] {} - Code: {}, Message: {}".format(msg, str(err[0]), err[1]))
+        logger.exception("[-] %s - %r", msg, err)
     else:
-        traceback.print_exc()
+        logger.exception("[-] Unexpected error")
 
 
-def proxy_loop(socket_src, socket_dst):
-    """ Wait for network activity """
-    while not EXIT.get_status():
-        try:
-            reader, _, _ = select.select([socket_src, socket_dst], [], [], 1)
-        except select.error as err:
-            error("Select failed", err)
-            return
-        if not reader:
-            continue
+def shutdown(*socks):
+    """ Wake up threads blocked on the sockets, they see EOF """
+    for sock in socks:
         try:
-            for sock in reader:
-                data = sock.recv(BUFSIZE)
-                if not data:
-                    return
-                if sock is socket_dst:
-                    socket_src.send(data)
-                else:
-                    socket_dst.send(data)
-        except socket.error as err:
-            error("Loop failed", err)
-            return
+            sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, ValueError):
+            pass
 
 
-def connect_to_dst(dst_addr, dst_port):
-    """ Connect to desired destination """
-    sock = create_socket()
+def tunnel_idle(socket_src, socket_dst):
+    stats.incr('tunnel_idle_closed')
+    shutdown(socket_src, socket_dst)
+
+
+def proxy_loop(socket_src, socket_dst):
+    """ Wait for network activity, returns bytes relayed (up, down) """
+    # no select timeout, the timer wheel shuts idle tunnels down
+    up = down = 0
+    idle = None
+    if IDLE_TIMEOUT:
+        idle = timerwheel.IdleTimer(IDLE_TIMEOUT, partial(tunnel_idle, socket_src, socket_dst))
+    try:
+        while not EXIT.get_status():
+            try:
+                reader, _, _ = select.select([socket_src, socket_dst], [], [])
+            except select.error as err:
+                error("Select failed", err)
+                return up, down
+            if idle:
+                idle.touch()
+            try:
+                for sock in reader:
+                    data = sock.recv(BUFSIZE)
+                    if not data:
+                        return up, down
+                    if sock is socket_dst:
+                        socket_src.sendall(data)
+                        down += len(data)
+                    else:
+                        socket_dst.sendall(data)
+                        up += len(data)
+            except socket.error as err:
+                error("Loop failed", err)
+                return up, down
+    finally:
+        if idle:
+            idle.cancel()
+    return up, down
+
+
+def setup_outgoing(sock):
+    """ Bind outgoing sockets to OUTGOING_INTERFACE """
     if OUTGOING_INTERFACE:
         try:
             sock.setsockopt(
@@ -128,85 +174,183 @@ def connect_to_dst(dst_addr, dst_port):
                 OUTGOING_INTERFACE.encode(),
             )
         except PermissionError as err:
-            print("[-] Only root can set OUTGOING_INTERFACE parameter")
+            logger.error("[-] Only root can set OUTGOING_INTERFACE parameter")
             EXIT.set_status(True)
+
+
+def connect_to_dst(dst_addr, dst_port):
+    """ Connect to desired destination """
     try:
-        sock.connect((dst_addr, dst_port))
-        print('[+] Connect to %s:%d' % (dst_addr, dst_port))
+        if isinstance(dst_addr, bytes):
+            dst_addr = dst_addr.decode('idna')
+        sock = netutil.create_connection(dst_addr, dst_port, TIMEOUT_SOCKET,
+                                         setup_outgoing)
+        logger.info('[+] Connect to %s:%d', dst_addr, dst_port)
         return sock
+    except UnicodeError as err:
+        # malformed domain name, replied as a resolution failure
+        logger.info('[-] Invalid domain name %r: %s', dst_addr, err)
+        return 0
     except socket.error as err:
         error("Failed to connect to DST", err)
         return 0
 
 
-def request_client(wrapper):
-    """ Client request details """
+class AddressTypeError(ValueError):
+    """ Unsupported ATYP, replied with code 08 """
+
+
+def read_message(wrapper, parse):
+    """
+        Read one SOCKS message, `parse(data)` returns (message, length) or
+        None while `data` is incomplete. Data is peeked and only the bytes of
+        the message are consumed, so anything the client pipelined after it
+        (the request after the greeting, a TLS ClientHello after the
+        request) stays in the socket for the next reader. Returns None on
+        EOF, raises ValueError on malformed messages.
+    """
+    pending = b''
+    while True:
+        peeked = wrapper.recv(BUFSIZE, socket.MSG_PEEK)
+        if not peeked:
+            return None
+        result = parse(pending + peeked)
+        if result is None:
+            # everything available belongs to this message, take it so the
+            # next peek blocks until more arrives
+            pending += wrapper.recv(len(peeked))
+            continue
+        message, length = result
+        if len(pending) + len(peeked) > length:
+            stats.incr('socks_pipelined')
+        length -= len(pending)
+        while length > 0:
+            data = wrapper.recv(length)
+            if not data:
+                return None
+            length -= len(data)
+        return message
+
+
+def parse_greeting(data):
+    """ Version identifier/method selection message, returns the methods """
+    # +----+----------+----------+
+    # |VER | NMETHODS | METHODS  |
+    # +----+----------+----------+
+    if len(data) < 2:
+        return None
+    if data[0:1] != VER:
+        raise ValueError('Unsupported version %d' % data[0])
+    length = 2 + data[1]
+    if len(data) < length:
+        return None
+    return data[2:length], length
+
+
+def parse_request(data):
+    """ Returns (cmd, dst_addr, dst_port), domain names are bytes """
     # +----+-----+-------+------+----------+----------+
     # |VER | CMD |  RSV  | ATYP | DST.ADDR | DST.PORT |
     # +----+-----+-------+------+----------+----------+
+    if len(data) < 5:
+        return None
+    if data[0:1] != VER or data[2:3] != b'\x00':
+        raise ValueError('Malformed request')
+    atyp = data[3:4]
+    if atyp == ATYP_IPV4:
+        addr_end = 8
+    elif atyp == ATYP_DOMAINNAME:
+        addr_end = 5 + data[4]
+    elif atyp == ATYP_IPV6:
+        addr_end = 20
+    else:
+        raise AddressTypeError('Unsupported address type %d' % data[3])
+    length = addr_end + 2
+    if len(data) < length:
+        return None
+
+    if atyp == ATYP_IPV4:
+        dst_addr = socket.inet_ntop(socket.AF_INET, data[4:addr_end])
+    elif atyp == ATYP_IPV6:
+        dst_addr = socket.inet_ntop(socket.AF_INET6, data[4:addr_end])
+    else:
+        dst_addr = data[5:addr_end]
+    dst_port = unpack('>H', data[addr_end:length])[0]
+    return (data[1:2], dst_addr, dst_port), length
+
+
+def request_client(wrapper):
+    """ Client request details, returns (dst_addr, dst_port) or a reply code """
     try:
-        s5_request = wrapper.recv(BUFSIZE)
-    except ConnectionResetError:
-        if wrapper != 0:
-            wrapper.close()
+        s5_request = read_message(wrapper, parse_request)
+    except AddressTypeError:
+        # Address type not supported
+        return b'\x08'
+    except ValueError:
+        return b'\x01'
+    except socket.error:
         error()
-        return False
-    # Check VER, CMD and RSV
-    if (
-            s5_request[0:1] != VER or
-            s5_request[1:2] != CMD_CONNECT or
-            s5_request[2:3] != b'\x00'
-    ):
-        return False
-    # IPV4
-    if s5_request[3:4] == ATYP_IPV4:
-        dst_addr = socket.inet_ntoa(s5_request[4:-2])
-        dst_port = unpack('>H', s5_request[8:len(s5_request)])[0]
-    # DOMAIN NAME
-    elif s5_request[3:4] == ATYP_DOMAINNAME:
-        sz_domain_name = s5_request[4]
-        dst_addr = s5_request[5: 5 + sz_domain_name - len(s5_request)]
-        port_to_unpack = s5_request[5 + sz_domain_name:len(s5_request)]
-        dst_port = unpack('>H', port_to_unpack)[0]
-    else:
-        return False
+        return b'\x01'
+    if s5_request is None:
+        return b'\x01'
+    cmd, dst_addr, dst_port = s5_request
+    if cmd != CMD_CONNECT:
+        # Command not supported
+        return b'\x07'
     return (dst_addr, dst_port)
 
 
-def request(wrapper):
+def destination(dst):
+    host, port = dst
+    if isinstance(host, bytes):
+        host = host.decode('ascii', 'replace')
+    return '[%s]:%d' % (host, port) if ':' in host else '%s:%d' % (host, port)
+
+
+def request(wrapper, deadline=None):
     """
         The SOCKS request information is sent by the client as soon as it has
         established a connection to the SOCKS server, and completed the
         authentication negotiations.  The server evaluates the request, and
         returns a reply
     """
-    dst = request_client(wrapper)
+    with tracing.span('socks.request'):
+        dst = request_client(wrapper)
+    if deadline:
+        deadline.cancel()
     # Server Reply
     # +----+-----+-------+------+----------+----------+
     # |VER | REP |  RSV  | ATYP | BND.ADDR | BND.PORT |
     # +----+-----+-------+------+----------+----------+
-    rep = b'\x07'
+    rep = b'\x01'
+    atyp = ATYP_IPV4
     bnd = b'\x00' + b'\x00' + b'\x00' + b'\x00' + b'\x00' + b'\x00'
     hijacked = False
+    socket_dst = 0
+    if isinstance(dst, bytes):
+        # rejected request, dst is the reply code
+        rep, dst = dst, None
     if dst:
         if dst[0] == hijacked_host.encode():
-            print('[*] Hijack %s to local server' % hijacked_host)
+            logger.info('[*] Hijack %s to local server', hijacked_host)
             hijacked = True
             socket_dst = True
         else:
-            socket_dst = connect_to_dst(dst[0], dst[1])
+            with tracing.span('socks.connect'):
+                socket_dst = connect_to_dst(dst[0], dst[1])
 
-    if not dst or socket_dst == 0:
-        rep = b'\x01'
-    else:
+    if socket_dst != 0:
         rep = b'\x00'
         if hijacked:
             bnd = b'\x01\x01\x01\x01\x01\x01'
         else:
-            bnd = socket.inet_aton(socket_dst.getsockname()[0])
-            bnd += pack(">H", socket_dst.getsockname()[1])
+            local = socket_dst.getsockname()
+            if socket_dst.family == socket.AF_INET6:
+                atyp = ATYP_IPV6
+            bnd = socket.inet_pton(socket_dst.family, local[0])
+            bnd += pack(">H", local[1])
 
-    reply = VER + rep + b'\x00' + ATYP_IPV4 + bnd
+    reply = VER + rep + b'\x00' + atyp + bnd
     try:
         wrapper.sendall(reply)
     except socket.error:
@@ -218,7 +362,9 @@ def request(wrapper):
         if hijacked:
             hijacker(wrapper)
         else:
-            proxy_loop(wrapper, socket_dst)
+            start = monotonic()
+            up, down = proxy_loop(wrapper, socket_dst)
+            traffic.record(destination(dst), up, down, monotonic() - start)
     if wrapper != 0:
         wrapper.close()
     if socket_dst != 0 and socket_dst != True:
@@ -230,22 +376,14 @@ def subnegotiation_client(wrapper):
         The client connects to the server, and sends a version
         identifier/method selection message
     """
-    # Client Version identifier/method selection message
-    # +----+----------+----------+
-    # |VER | NMETHODS | METHODS  |
-    # +----+----------+----------+
     try:
-        identification_packet = wrapper.recv(BUFSIZE)
+        methods = read_message(wrapper, parse_greeting)
+    except ValueError:
+        return M_NOTAVAILABLE
     except socket.error:
         error()
         return M_NOTAVAILABLE
-    # VER field
-    if VER != identification_packet[0:1]:
-        return M_NOTAVAILABLE
-    # METHODS fields
-    nmethods = identification_packet[1]
-    methods = identification_packet[2:]
-    if len(methods) != nmethods:
+    if methods is None:
         return M_NOTAVAILABLE
     for method in methods:
         if method == ord(M_NOAUTH):
@@ -276,10 +414,87 @@ def subnegotiation(wrapper):
     return True
 
 
+def pac_script():
+    """ Proxy auto-config which routes only the hijacked host to us """
+    return (
+        'function FindProxyForURL(url, host) {\n'
+        '    if (host == "%s")\n'
+        '        return "SOCKS5 %s:%d; SOCKS %s:%d";\n'
+        '    return "DIRECT";\n'
+        '}\n'
+    ) % (hijacked_host, LOCAL_ADDR, LOCAL_PORT, LOCAL_ADDR, LOCAL_PORT)
+
+
+def http_reply(wrapper, status, content_type, body, head=False):
+    """ Send a minimal HTTP/1.0 response, `head` sends the headers only """
+    header = 'HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n' \
+             'Cache-Control: no-cache\r\nConnection: close\r\n\r\n' % (
+                 status, content_type, len(body))
+    try:
+        wrapper.sendall(header.encode('ascii') + (b'' if head else body))
+    except socket.error:
+        error()
+
+
+def http_request(wrapper):
+    """ Serve plain HTTP requests to the proxy port, i.e. the PAC file """
+    data = b''
+    while b'\r\n\r\n' not in data and len(data) < MAX_HTTP_HEADER:
+        try:
+            chunk = wrapper.recv(BUFSIZE)
+        except socket.error:
+            return
+        if not chunk:
+            return
+        data += chunk
+
+    request_line = data.split(b'\r\n', 1)[0].decode('latin-1').split()
+    if len(request_line) != 3 or request_line[0] not in ('GET', 'HEAD'):
+        http_reply(wrapper, '400 Bad Request', 'text/plain', b'')
+        return
+
+    path = request_line[1].split('?', 1)[0]
+    if path == PAC_PATH:
+        logger.info('[*] Serve proxy auto-config')
+        http_reply(wrapper, '200 OK', 'application/x-ns-proxy-autoconfig',
+                   pac_script().encode('ascii'), head=request_line[0] == 'HEAD')
+    else:
+        http_reply(wrapper, '404 Not Found', 'text/plain', b'')
+
+
 def connection(wrapper):
     """ Function run by a thread """
-    if subnegotiation(wrapper):
-        request(wrapper)
+    # the trace of everything served over this socket
+    with tracing.span('socks.connection', root=True):
+        serve_connection(wrapper)
+
+
+def handshake_timeout(wrapper):
+    stats.incr('socks_handshake_timeout')
+    shutdown(wrapper)
+
+
+def serve_connection(wrapper):
+    # clients which don't finish the handshake in time see EOF
+    deadline = timerwheel.schedule(TIMEOUT_SOCKET, partial(handshake_timeout, wrapper))
+    try:
+        # SOCKS5 starts with version byte 0x05, anything else may be HTTP
+        try:
+            first = wrapper.recv(1, socket.MSG_PEEK)
+        except socket.error:
+            error()
+            wrapper.close()
+            return
+        if first not in (VER, b''):
+            http_request(wrapper)
+            wrapper.close()
+            return
+        with tracing.span('socks.greeting'):
+            accepted = subnegotiation(wrapper)
+        if accepted:
+            request(wrapper, deadline)
+    finally:
+        deadline.cancel()
 
 
 def create_socket():
@@ -299,8 +514,10 @@ def bind_port(sock):
         listen for connections made to the socket
     """
     try:
-        print('[+] Socks5 proxy bind on {}:{}'.format(LOCAL_ADDR, str(LOCAL_PORT)))
+        logger.info('[+] Socks5 proxy bind on %s:%d', LOCAL_ADDR, LOCAL_PORT)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if REUSE_PORT:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.bind((LOCAL_ADDR, LOCAL_PORT))
     except socket.error as err:
         error("Bind failed", err)
@@ -318,11 +535,11 @@ def bind_port(sock):
 
 def exit_handler(signum, frame):
     """ Signal handler called with signal, exit script """
-    print('[*] Signal handler called with signal', signum)
+    logger.info('[*] Signal handler called with signal %d', signum)
     EXIT.set_status(True)
 
 
-def main(hijack, host):
+def main(hijack, host, on_ready=None):
     """ Main function """
     global hijacker
     global hijacked_host
@@ -330,6 +547,8 @@ def main(hijack, host):
     hijacked_host = host
     new_socket = create_socket()
     bind_port(new_socket)
+    if on_ready:
+        on_ready()
     #signal(SIGINT, exit_handler)
     #signal(SIGTERM, exit_handler)
     while not EXIT.get_status():
@@ -347,7 +566,8 @@ def main(hijack, host):
         except TypeError:
             error()
             sys.exit(0)
-        recv_thread = Thread(target=connection, args=(wrapper, ))
+        recv_thread = Thread(target=connection, args=(wrapper, ),
+                             name='socks-%d' % wrapper.fileno())
         recv_thread.start()
     new_socket.close()
 
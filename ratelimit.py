@@ -0,0 +1,187 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""
+ Rate limits and fair queuing for card and SAM commands
+
+ An owner is `(origin, connection)`. Every card command takes a token from
+ the bucket of its connection and of its origin, and the reader lock is
+ handed out round-robin: first across origins, then across the connections
+ of an origin, so one busy page can not starve other tabs.
+"""
+
+import collections
+import os
+import threading
+import time
+
+import stats
+
+# tokens per second and bucket size, a rate of 0 disables the limit
+RATE_LIMIT_ORIGIN = float(os.getenv('RATE_LIMIT_ORIGIN', 5))
+RATE_LIMIT_ORIGIN_BURST = int(os.getenv('RATE_LIMIT_ORIGIN_BURST', 20))
+RATE_LIMIT_CONNECTION = float(os.getenv('RATE_LIMIT_CONNECTION', 2))
+RATE_LIMIT_CONNECTION_BURST = int(os.getenv('RATE_LIMIT_CONNECTION_BURST', 10))
+MAX_ORIGINS = 256
+
+# commands which touch the card or the SAM service
+CARD_COMMANDS = ('GetBasic', 'EnCrypt?', 'H_Sign?', 'SecureGetBasicWithParam?')
+
+def command_cost(cmd):
+    if cmd.startswith('H_SignBatch?'):
+        return cmd.count(',') + 1
+    return 1 if cmd.startswith(CARD_COMMANDS) else 0
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        # `now` may predate a bucket created after it was read
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+class RateLimiter:
+    def __init__(self, origin_rate=RATE_LIMIT_ORIGIN, origin_burst=RATE_LIMIT_ORIGIN_BURST,
+                 connection_rate=RATE_LIMIT_CONNECTION,
+                 connection_burst=RATE_LIMIT_CONNECTION_BURST):
+        self.origin_rate = origin_rate
+        self.origin_burst = origin_burst
+        self.connection_rate = connection_rate
+        self.connection_burst = connection_burst
+        self.origins = collections.OrderedDict()
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def origin_bucket(self, origin):
+        bucket = self.origins.get(origin)
+        if bucket is None:
+            bucket = self.origins[origin] = TokenBucket(self.origin_rate, self.origin_burst)
+            # an evicted origin starts again with a full bucket
+            while len(self.origins) > MAX_ORIGINS:
+                self.origins.popitem(last=False)
+        else:
+            self.origins.move_to_end(origin)
+        return bucket
+
+    def connection_bucket(self, owner):
+        bucket = self.connections.get(owner)
+        if bucket is None:
+            bucket = self.connections[owner] = TokenBucket(
+                    self.connection_rate, self.connection_burst)
+        return bucket
+
+    def allow(self, owner, cost=1):
+        """
+            Take `cost` tokens from both buckets of `owner`, or none of them.
+            A request costing more than a bucket holds (a large H_SignBatch)
+            passes with a full bucket and leaves it in debt, later requests
+            wait until the debt is paid back.
+        """
+        if cost <= 0:
+            return True
+
+        now = time.monotonic()
+        with self.lock:
+            buckets = []
+            if self.connection_rate > 0:
+                buckets.append(('connection', self.connection_bucket(owner)))
+            if self.origin_rate > 0:
+                buckets.append(('origin', self.origin_bucket(owner[0])))
+
+            for scope, bucket in buckets:
+                bucket.refill(now)
+                if bucket.tokens < min(cost, bucket.burst):
+                    stats.incr('rate_limited_%s' % scope)
+                    return False
+            for scope, bucket in buckets:
+                bucket.tokens -= cost
+        stats.incr('rate_allowed', cost)
+        return True
+
+    def forget(self, owner):
+        with self.lock:
+            self.connections.pop(owner, None)
+
+    def report(self):
+        with self.lock:
+            return {
+                'origins': len(self.origins),
+                'connections': len(self.connections),
+            }
+
+class FairLock:
+    """
+        Mutex granted round-robin across origins, then across connections of
+        the same origin, waiters of one connection are served in order
+    """
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.held = False
+        # origin -> connection -> deque of waiting events
+        self.waiting = collections.OrderedDict()
+        self.waiters = 0
+
+    def acquire(self, owner=None):
+        origin, connection = owner or (None, None)
+        with self.mutex:
+            if not self.held:
+                self.held = True
+                return True
+            event = threading.Event()
+            connections = self.waiting.setdefault(origin, collections.OrderedDict())
+            connections.setdefault(connection, collections.deque()).append(event)
+            self.waiters += 1
+
+        stats.incr('card_lock_waits')
+        start = time.monotonic()
+        event.wait()
+        stats.incr('card_lock_wait_ms', int((time.monotonic() - start) * 1000))
+        return True
+
+    def release(self):
+        with self.mutex:
+            if not self.waiting:
+                self.held = False
+                return
+
+            # ownership is handed to the next waiter, `held` stays set
+            origin, connections = self.waiting.popitem(last=False)
+            connection, events = connections.popitem(last=False)
+            event = events.popleft()
+            if events:
+                connections[connection] = events
+            if connections:
+                self.waiting[origin] = connections
+            self.waiters -= 1
+        event.set()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def report(self):
+        with self.mutex:
+            return {'held': self.held, 'waiters': self.waiters}
@@ -0,0 +1,504 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+#!/usr/bin/env python3
+"""
+ Remote reader: serve locally attached readers to agents on other hosts
+
+ The RPC works at APDU level, a `RemoteConnection` behaves like a pyscard
+ card connection, so `HealthInsuranceSmartcardClient(RemoteConnection(...))`
+ runs every card operation against the remote reader.
+
+ Wire format (big endian):
+   request  : request_id u32 | op u8 | reader u8 | length u16 | payload
+   response : request_id u32 | status u8 | length u16 | payload
+
+ Requests may be pipelined, every reader executes its requests in order. A
+ connection holding a transaction (BEGIN .. END) has the reader for itself,
+ requests of other connections wait until END or disconnect.
+
+ There is no encryption, bind to loopback or a trusted network and set
+ REMOTE_READER_TOKEN on both sides.
+"""
+
+import argparse
+import collections
+import hmac
+import logging
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+
+from hccard import HealthInsuranceSmartcardClient, SmartcardException, \
+        begin_transaction, end_transaction, connect_shared
+
+logger = logging.getLogger('remote_reader')
+
+REQUEST = struct.Struct('>IBBH')
+RESPONSE = struct.Struct('>IBH')
+
+OP_PING = 0
+OP_LIST = 1
+OP_TRANSMIT = 2
+OP_BEGIN = 3
+OP_END = 4
+OP_HELLO = 5
+# internal, queued to readers when a connection goes away
+OP_CLOSE = 0xff
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_DENIED = 2
+
+DEFAULT_PORT = 17900
+REMOTE_READER_TOKEN = os.getenv('REMOTE_READER_TOKEN', '')
+POOL_SIZE = 4
+TIMEOUT_SOCKET = 10
+
+class RemoteReaderError(SmartcardException):
+    pass
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        data += chunk
+    return data
+
+#
+# Server
+#
+
+class Request:
+    __slots__ = ('session', 'request_id', 'op', 'payload')
+
+    def __init__(self, session, request_id, op, payload):
+        self.session = session
+        self.request_id = request_id
+        self.op = op
+        self.payload = payload
+
+class ReaderWorker(threading.Thread):
+    """ Owns the card connection of one reader and runs its request queue """
+    def __init__(self, name, connect):
+        super().__init__(name='reader-%s' % name, daemon=True)
+        self.reader_name = name
+        self.connect = connect
+        self.conn = None
+        self.queue = queue.Queue()
+        self.deferred = collections.deque()
+        self.owner = None
+        self.in_transaction = False
+
+    def put(self, request):
+        self.queue.put(request)
+
+    def next_request(self):
+        if self.owner is not None and self.owner.closed:
+            # never wait for a connection which is gone
+            self.end()
+        if self.owner is not None:
+            # the transaction owner may have pipelined requests behind BEGIN
+            for i, request in enumerate(self.deferred):
+                if request.session is self.owner:
+                    del self.deferred[i]
+                    return request
+        elif self.deferred:
+            return self.deferred.popleft()
+
+        while True:
+            request = self.queue.get()
+            if self.owner is not None and request.session is not self.owner \
+                    and request.op != OP_CLOSE:
+                self.deferred.append(request)
+                continue
+            return request
+
+    def get_conn(self):
+        if self.conn is None:
+            self.conn = self.connect()
+        return self.conn
+
+    def reset(self):
+        # card removed or reader reset, reconnect on next request
+        conn, self.conn = self.conn, None
+        self.in_transaction = False
+        try:
+            conn.disconnect()
+        except Exception:
+            pass
+
+    def transmit(self, apdu):
+        try:
+            data, sw1, sw2 = self.get_conn().transmit(list(apdu))
+        except Exception:
+            self.reset()
+            raise
+        return bytes(data) + bytes([sw1, sw2])
+
+    def begin(self):
+        # local applications sharing the reader have to wait as well
+        try:
+            begin_transaction(self.get_conn())
+        except Exception:
+            self.reset()
+            raise
+        self.in_transaction = True
+
+    def end(self):
+        self.owner = None
+        if self.in_transaction:
+            self.in_transaction = False
+            try:
+                end_transaction(self.conn)
+            except Exception:
+                self.reset()
+
+    def handle(self, request):
+        session, op = request.session, request.op
+        if op == OP_CLOSE:
+            # drop what it queued behind the transaction of another session,
+            # a BEGIN replayed later would hold the reader forever
+            self.deferred = collections.deque(
+                    r for r in self.deferred if r.session is not session)
+            if self.owner is session:
+                self.end()
+            return
+        elif session.closed:
+            # nobody reads the reply
+            return
+        elif op == OP_BEGIN:
+            if self.owner is not session:
+                try:
+                    self.begin()
+                except Exception as e:
+                    session.reply(request.request_id, STATUS_ERROR, repr(e).encode())
+                    return
+                self.owner = session
+            session.reply(request.request_id, STATUS_OK)
+        elif op == OP_END:
+            if self.owner is session:
+                self.end()
+            session.reply(request.request_id, STATUS_OK)
+        elif op == OP_TRANSMIT:
+            try:
+                result = self.transmit(request.payload)
+            except Exception as e:
+                session.reply(request.request_id, STATUS_ERROR, repr(e).encode())
+            else:
+                session.reply(request.request_id, STATUS_OK, result)
+
+    def run(self):
+        while True:
+            self.handle(self.next_request())
+
+class Session(threading.Thread):
+    """ One client connection """
+    def __init__(self, server, sock, peer):
+        super().__init__(name='remote-%s:%d' % peer[:2], daemon=True)
+        self.server = server
+        self.sock = sock
+        self.peer = peer
+        self.send_lock = threading.Lock()
+        self.authenticated = not server.token
+        self.closed = False
+
+    def reply(self, request_id, status, payload=b''):
+        with self.send_lock:
+            try:
+                self.sock.sendall(RESPONSE.pack(request_id, status, len(payload)) + payload)
+            except OSError:
+                pass
+
+    def run(self):
+        logger.info('[+] Remote client connected: %s:%d', *self.peer[:2])
+        try:
+            while True:
+                request_id, op, reader, size = REQUEST.unpack(
+                        recv_exact(self.sock, REQUEST.size))
+                payload = recv_exact(self.sock, size)
+                self.dispatch(request_id, op, reader, payload)
+        except (OSError, ConnectionError, struct.error):
+            pass
+        finally:
+            self.closed = True
+            for worker in self.server.workers:
+                worker.put(Request(self, 0, OP_CLOSE, b''))
+            self.sock.close()
+            logger.info('[-] Remote client disconnected: %s:%d', *self.peer[:2])
+
+    def dispatch(self, request_id, op, reader, payload):
+        if op == OP_HELLO:
+            token = self.server.token.encode()
+            self.authenticated = hmac.compare_digest(payload, token)
+            self.reply(request_id, STATUS_OK if self.authenticated else STATUS_DENIED)
+        elif not self.authenticated:
+            self.reply(request_id, STATUS_DENIED)
+        elif op == OP_PING:
+            self.reply(request_id, STATUS_OK)
+        elif op == OP_LIST:
+            names = '\n'.join(w.reader_name for w in self.server.workers)
+            self.reply(request_id, STATUS_OK, names.encode('utf-8'))
+        elif op in (OP_TRANSMIT, OP_BEGIN, OP_END) and reader < len(self.server.workers):
+            self.server.workers[reader].put(Request(self, request_id, op, payload))
+        else:
+            self.reply(request_id, STATUS_ERROR, b'Invalid request')
+
+class RemoteReaderServer:
+    def __init__(self, readers, token=REMOTE_READER_TOKEN):
+        """ `readers` is a list of (name, connect) """
+        self.token = token
+        self.workers = [ReaderWorker(name, connect) for name, connect in readers]
+
+    def serve_forever(self, addr, port):
+        for worker in self.workers:
+            worker.start()
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((addr, port))
+        listener.listen(32)
+        logger.info('[+] Remote reader server bind on %s:%d', addr, port)
+        for i, worker in enumerate(self.workers):
+            logger.info('[*] Reader %d: %s', i, worker.reader_name)
+
+        while True:
+            sock, peer = listener.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Session(self, sock, peer).start()
+
+def local_readers():
+    from smartcard.System import readers as get_readers
+
+    def connector(reader):
+        def connect():
+            conn = reader.createConnection()
+            connect_shared(conn)
+            return conn
+        return connect
+
+    return [(str(reader), connector(reader)) for reader in get_readers()]
+
+#
+# Client
+#
+
+class RemoteConnection:
+    """ pyscard card connection look-alike backed by a remote reader """
+    def __init__(self, host, port, reader=0, token=REMOTE_READER_TOKEN, pool=None):
+        self.host = host
+        self.port = port
+        self.reader = reader
+        self.token = token
+        self.pool = pool
+        self.sock = None
+        self.next_id = 0
+        self.in_transaction = False
+        # set by the pool when handing out an idle connection
+        self.pooled = False
+        self.replied = False
+        self.open()
+
+    def open(self):
+        self.sock = socket.create_connection((self.host, self.port), TIMEOUT_SOCKET)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.token:
+            status, _ = self.request(OP_HELLO, self.token.encode())
+            if status != STATUS_OK:
+                self.close()
+                raise RemoteReaderError('Remote reader refused the token')
+
+    def send_requests(self, requests):
+        ids = []
+        frames = []
+        for op, payload in requests:
+            self.next_id = (self.next_id + 1) & 0xffffffff
+            ids.append(self.next_id)
+            frames.append(REQUEST.pack(self.next_id, op, self.reader, len(payload)) + payload)
+        self.replied = False
+        self.sock.sendall(b''.join(frames))
+
+        chunk = self.sock.recv(RESPONSE.size)
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        self.replied = True
+
+        results = []
+        for request_id in ids:
+            header = chunk + recv_exact(self.sock, RESPONSE.size - len(chunk))
+            chunk = b''
+            response_id, status, size = RESPONSE.unpack(header)
+            payload = recv_exact(self.sock, size)
+            if response_id != request_id:
+                raise RemoteReaderError('Out of order response')
+            results.append((status, payload))
+        return results
+
+    def exchange(self, requests):
+        """
+            `send_requests`, raising RemoteReaderError on connection errors.
+            The server may have closed an idle pooled connection, so the
+            first requests after `RemoteReaderPool.acquire` are sent once
+            more on a fresh connection if they got no reply bytes at all.
+        """
+        retry, self.pooled = self.pooled, False
+        while True:
+            try:
+                return self.send_requests(requests)
+            except (OSError, ConnectionError) as e:
+                self.close()
+                if not retry or self.replied:
+                    raise RemoteReaderError('Remote reader connection failed: %r' % e)
+                retry = False
+                logger.info('[*] Pooled remote reader connection failed, reconnecting: %r', e)
+                try:
+                    self.open()
+                except OSError as e:
+                    raise RemoteReaderError('Remote reader connection failed: %r' % e)
+
+    def request(self, op, payload=b''):
+        return self.exchange([(op, payload)])[0]
+
+    @staticmethod
+    def parse_transmit(status, payload):
+        if status != STATUS_OK:
+            raise RemoteReaderError(payload.decode('utf-8', 'replace'))
+        return list(payload[:-2]), payload[-2], payload[-1]
+
+    def connect(self, *args, **kwargs):
+        pass
+
+    def transmit(self, apdu):
+        return self.parse_transmit(*self.request(OP_TRANSMIT, bytes(apdu)))
+
+    def transmit_many(self, apdus):
+        """ Pipeline APDUs, returns a list of (data, sw1, sw2) """
+        results = self.exchange([(OP_TRANSMIT, bytes(apdu)) for apdu in apdus])
+        return [self.parse_transmit(status, payload) for status, payload in results]
+
+    def begin_transaction(self):
+        status, payload = self.request(OP_BEGIN)
+        if status != STATUS_OK:
+            raise RemoteReaderError(payload.decode('utf-8', 'replace'))
+        self.in_transaction = True
+
+    def end_transaction(self):
+        self.in_transaction = False
+        self.request(OP_END)
+
+    def list_readers(self):
+        status, payload = self.request(OP_LIST)
+        return payload.decode('utf-8').split('\n') if payload else []
+
+    def disconnect(self):
+        # give the connection back to the pool instead of closing it
+        if self.in_transaction:
+            try:
+                self.end_transaction()
+            except RemoteReaderError:
+                return
+        if self.pool is not None and self.sock is not None:
+            self.pool.release(self)
+        else:
+            self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+class RemoteReaderPool:
+    def __init__(self, host, port, reader=0, size=POOL_SIZE, token=REMOTE_READER_TOKEN):
+        self.host = host
+        self.port = port
+        self.reader = reader
+        self.size = size
+        self.token = token
+        self.idle = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_address(cls, address, **kwargs):
+        """ `host:port` or `host:port/reader` """
+        address, _, reader = address.partition('/')
+        host, _, port = address.rpartition(':')
+        return cls(host, int(port or DEFAULT_PORT), int(reader or 0), **kwargs)
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                conn = self.idle.pop()
+                conn.pooled = True
+                return conn
+        return RemoteConnection(self.host, self.port, self.reader, self.token, pool=self)
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve smartcard readers over TCP')
+    sub = parser.add_subparsers(dest='command')
+
+    serve = sub.add_parser('serve', help='serve local readers')
+    serve.add_argument('--bind', default='127.0.0.1:%d' % DEFAULT_PORT)
+    serve.add_argument('--mock', type=int, default=0,
+                       help='serve this many simulated cards instead of real readers')
+
+    read = sub.add_parser('read', help='read basic data from a remote reader')
+    read.add_argument('address', help='host:port[/reader]')
+    read.add_argument('-n', '--count', type=int, default=1)
+
+    lst = sub.add_parser('list', help='list readers of a remote host')
+    lst.add_argument('address', help='host:port')
+
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO', stream=sys.stdout)
+
+    if args.command == 'serve':
+        addr, _, port = args.bind.rpartition(':')
+        if args.mock:
+            import mockcard
+            readers = [('Mock Reader %d' % i, lambda i=i: mockcard.connect('Mock Reader %d' % i))
+                       for i in range(args.mock)]
+        else:
+            readers = local_readers()
+        RemoteReaderServer(readers).serve_forever(addr, int(port))
+    elif args.command == 'list':
+        conn = RemoteReaderPool.from_address(args.address).acquire()
+        for i, name in enumerate(conn.list_readers()):
+            print('%-2d : %s' % (i, name))
+        conn.close()
+    elif args.command == 'read':
+        pool = RemoteReaderPool.from_address(args.address)
+        for _ in range(args.count):
+            with HealthInsuranceSmartcardClient(pool.acquire()) as client, \
+                    client.transaction():
+                client.select_applet()
+                print(client.get_basic())
+    else:
+        parser.print_help()
+
+if __name__ == '__main__':
+    main()
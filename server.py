@@ -15,171 +15,570 @@
 # If not, see <https://www.gnu.org/licenses/>.
 
 #!/usr/bin/env python3
+import startup  # keep this first, it measures the time spent on imports
+
 import asyncio
 import atexit
+import concurrent.futures
 import contextlib
+import functools
 import http
+import json
 import logging
 import os
+import re
+import socket
 import ssl
 import subprocess
-import sys
 import threading
+import time
+import urllib.parse
 
 import websockets
 from hccard import HealthInsuranceSmartcardClient, select_reader_and_connect, \
         SmartcardCommandException
 from cryptos import card_encrypt, basic_encrypt
-from complicated_sam_hc_auth import sam_hc_auth, sam_hc_auth_check
+from complicated_sam_hc_auth import sam_hc_auth, sam_hc_auth_batch, \
+        sam_hc_auth_check, load_crypto_modules, SAM_CHECK_TTL, SAM_WARM_UP
+import complicated_sam_hc_auth
 from errors import ServiceError
+import agentlog
+import flightrecorder
+import profiler
+import ratelimit
+import stats
+import timerwheel
+import tracing
+import traffic
 
-logging.basicConfig(level='INFO', stream=sys.stdout)
-logger = logging.getLogger('server')
+startup.mark('import modules')
 
 HOST = 'iccert.nhi.gov.tw'
 CENSORED_COMMANDS = ['EnCrypt', 'SecureGetBasicWithParam', 'GetBasic']
-
-lock = threading.Lock()
+# batch messages are JSON objects, no single command starts with `{`
+BATCH_PREFIX = '{'
+MAX_BATCH_SIZE = 16
+MAX_SIGN_BATCH_SIZE = 64
+# ASCII only, str.isalnum() also accepts 'é' or '１' which can't be encoded
+SIGN_PAYLOAD = re.compile('0001[0-9A-Za-z]{16}')
+
+agentlog.setup_logging(CENSORED_COMMANDS)
+logger = logging.getLogger('server')
+startup.mark('setup logging')
+
+# TLS sessions (tickets and server side cache) are valid for this many
+# seconds, set to 0 to disable session resumption
+TLS_SESSION_LIFETIME = int(os.getenv('TLS_SESSION_LIFETIME', 3600))
+# `performance` prefers AES-GCM and ECDHE key exchange, `compat` keeps
+# OpenSSL defaults
+TLS_PROFILE = os.getenv('TLS_PROFILE', 'performance')
+# e.g. `prime256v1`, leave empty to let OpenSSL pick (X25519 first)
+TLS_ECDH_CURVE = os.getenv('TLS_ECDH_CURVE', '')
+PERFORMANCE_CIPHERS = 'ECDHE+AESGCM+AES128:ECDHE+CHACHA20:ECDHE+AESGCM'
+# load crypto and smartcard modules in background once the proxy is up,
+# otherwise they are loaded by the first command which needs them
+PRELOAD_MODULES = os.getenv('PRELOAD_MODULES', '1') != '0'
+# threads running card and SAM commands, they are serialized by `lock`
+# anyway, extra threads only serve the commands which don't need the card
+COMMAND_WORKERS = int(os.getenv('COMMAND_WORKERS', 4))
+# listen for wss directly on this port, for deployments where
+# iccert.nhi.gov.tw resolves to this machine (hosts file or DNS), 0 disables
+DIRECT_WSS_ADDR = os.getenv('DIRECT_WSS_ADDR', '127.0.0.1')
+DIRECT_WSS_PORT = int(os.getenv('DIRECT_WSS_PORT', 0))
+# extra SOCKS acceptor processes sharing the proxy port (needs SO_REUSEPORT),
+# hijacked connections are relayed to the wss listener of this process
+PROXY_WORKERS = int(os.getenv('PROXY_WORKERS', 0))
+# use a reader served by `remote_reader.py serve` on another host,
+# host:port or host:port/reader_index
+REMOTE_READER = os.getenv('REMOTE_READER', '')
+# close wss connections without commands for this many seconds, 0 disables
+WS_IDLE_TIMEOUT = int(os.getenv('WS_IDLE_TIMEOUT', 600))
+
+# card commands queue for the reader fairly across origins and connections
+lock = ratelimit.FairLock()
+limiter = ratelimit.RateLimiter()
 
 class HTTP(websockets.WebSocketServerProtocol):
+    def connection_made(self, transport):
+        # for TLS connections this is called after the handshake completed
+        ssl_object = transport.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            if ssl_object.session_reused:
+                stats.incr('tls_handshake_resumed')
+            else:
+                stats.incr('tls_handshake_full')
+        super().connection_made(transport)
+
+    def is_local_request(self):
+        peer = self.transport.get_extra_info('peername')
+        return bool(peer) and peer[0] in ('127.0.0.1', '::1')
+
     async def process_request(self, path, request_headers):
         if path == '/echo':
             return await super().process_request(path, request_headers)
         elif path == '/exit':
-            exit()
+            # only this connection, the direct listener loop serves others
+            self.transport.abort()
+            return http.HTTPStatus.GONE, [], b''
         elif path == '/':
             body = b'It works!\n'
             return http.HTTPStatus.OK, [('Content-Length', str(len(body)))], body
+        elif path == '/stats' and self.is_local_request():
+            return self.json_response(stats.snapshot())
+        elif path.startswith('/debug/traces') and self.is_local_request():
+            # /debug/traces for the per-stage breakdown, ?trace=<id> for one trace
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+            return self.json_response(tracing.report(query.get('trace', [None])[0]))
+        elif path.startswith('/debug/traffic') and self.is_local_request():
+            # /debug/traffic?n=20, destinations of proxied tunnels by bytes
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+            try:
+                n = int(query.get('n', [20])[0])
+            except ValueError:
+                return http.HTTPStatus.BAD_REQUEST, [], b''
+            return self.json_response(traffic_report(n))
+        elif path == '/debug/slow' and self.is_local_request():
+            return self.json_response(flightrecorder.recorder.report())
+        elif path.startswith('/debug/profile') and self.is_local_request():
+            # /debug/profile?seconds=N, collapsed stacks for flame graphs
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(path).query)
+            try:
+                seconds = float(query.get('seconds', [profiler.PROFILE_SECONDS])[0])
+            except ValueError:
+                return http.HTTPStatus.BAD_REQUEST, [], b''
+            body = await asyncio.get_event_loop().run_in_executor(
+                    None, profiler.profile, seconds)
+            if body is None:
+                return http.HTTPStatus.CONFLICT, [], b'A profile is already running\n'
+            body = body.encode('utf-8')
+            return http.HTTPStatus.OK, [
+                ('Content-Type', 'text/plain; charset=utf-8'),
+                ('Content-Length', str(len(body))),
+            ], body
         else:
             return http.HTTPStatus.NOT_FOUND, [], b''
 
+    @staticmethod
+    def json_response(data):
+        body = json.dumps(data, indent=2).encode() + b'\n'
+        return http.HTTPStatus.OK, [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+        ], body
+
     @staticmethod
     def process_origin(headers, origins):
         origin = websockets.WebSocketServerProtocol.process_origin(headers, origins)
 
         if origin:
-            print('[*] wss connection from: %s' % origin)
+            logger.info('[*] wss connection from: %s', origin)
 
         if not origin or not origin.endswith('.gov.tw') and \
                 not origin.endswith('iccert.nhi.gov.tw:7777'):
             raise websockets.InvalidOrigin(origin)
 
-
+        # the page may ask for a signature soon
+        complicated_sam_hc_auth.warm_up('origin')
         return origin
 
+remote_reader_pool = None
+
 def connect_reader():
+    global remote_reader_pool
     try:
+        if REMOTE_READER:
+            if remote_reader_pool is None:
+                import remote_reader
+                remote_reader_pool = remote_reader.RemoteReaderPool.from_address(REMOTE_READER)
+            return HealthInsuranceSmartcardClient(remote_reader_pool.acquire())
         return HealthInsuranceSmartcardClient()
     except:
         raise ServiceError(8013, 'Can not connect to smartcard reader')
 
-def get_basic_data():
-    with lock, connect_reader() as client:
+class CardSession:
+    """
+        Reader connection shared by the commands of a batch, the reader is
+        locked and connected on first use only. PC/SC transactions cover
+        single card reads and single signatures (see `transaction`), other
+        applications sharing the reader may use it in between. A signature
+        holds its transaction across the SAM challenge and signature round
+        trips, the card random must be consumed by the mutual auth.
+    """
+    def __init__(self, owner=None):
+        """ `owner` is the (origin, connection) queuing for the reader """
+        self.owner = owner
+        self.client = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_client(self):
+        if self.client is not None:
+            return self.client
+
+        with tracing.span('lock.wait'):
+            lock.acquire(self.owner)
+        try:
+            with tracing.span('reader.connect'):
+                client = connect_reader()
+        except:
+            lock.release()
+            raise
+
+        self.client = client
+        return client
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+            Select the applet and run a sequence of APDUs without other
+            applications interleaving, the applet may have been changed by
+            them since the last transaction
+        """
+        client = self.get_client()
         try:
+            client.begin_transaction()
             client.select_applet()
-            data = list(client.get_basic()[:-1])
-            data.append(client.get_hc_card_data().decode('ascii')[:1])
-            return ','.join(data)
-        except SmartcardCommandException as e:
+        except SmartcardCommandException:
+            client.end_transaction()
             raise
         except:
-            raise ServiceError(8011, 'Failed to read basic data from smartcard')
+            client.end_transaction()
+            raise ServiceError(7004, 'Failed to select applet')
+        try:
+            yield client
+        finally:
+            client.end_transaction()
+
+    def close(self):
+        if self.client is not None:
+            try:
+                self.client.close()
+            finally:
+                self.client = None
+                lock.release()
 
-def get_basic_data_encrypted(password):
+def get_basic_blob(session):
+    """ GetBasic response body, big5-hkscs encoded """
+    try:
+        with session.transaction() as client:
+            basic, card_data = client.get_basic_and_card_data()
+        return basic.to_wire(card_data)
+    except (SmartcardCommandException, ServiceError):
+        raise
+    except:
+        raise ServiceError(8011, 'Failed to read basic data from smartcard')
+
+def get_basic_data(session):
+    try:
+        return get_basic_blob(session).decode('big5-hkscs')
+    except UnicodeDecodeError:
+        raise ServiceError(8011, 'Failed to read basic data from smartcard')
+
+def get_basic_data_encrypted(session, password):
     # Yes, password was not used to encrypt the data!
     # maybe we should remove the password argument and rename it to encoded?
-    blob = get_basic_data().encode('big5-hkscs')
-    return basic_encrypt(blob).hex().upper()
+    return basic_encrypt(get_basic_blob(session)).hex().upper()
+
+def run_command(cmd, session=None, owner=None):
+    if session is None:
+        with CardSession(owner) as session:
+            return run_command(cmd, session)
+
+    prefix = ''
 
-async def handler(ws, path):
     try:
-        while True:
-            cmd = await ws.recv()
-            log_censored = any(cmd.startswith(c) for c in CENSORED_COMMANDS)
-            def censor_data(data, splitter='='):
-                if log_censored:
-                    data_list = data.split(splitter, maxsplit=1)
-                    if len(data_list) == 1:
-                        return data
-                    else:
-                        return data_list[0] + splitter + '...(censored)'
-                return data
-            logger.info('InCmd = {{{ %s }}}' % censor_data(cmd))
-            prefix = ''
+        if cmd == 'Exit':
+            exit()
 
-            try:
-                if cmd == 'Exit':
-                    exit()
-
-                elif cmd == 'GetVersion':
-                    ret = 'GetVersion:0001'
-
-                elif cmd == 'GetBasic':
-                    prefix = 'GetBasic:'
-                    ret = get_basic_data()
-
-                elif cmd == 'GetRandom':
-                    rnd = int.from_bytes(os.urandom(8), 'little')
-                    ret = str(rnd).zfill(16)[-16:]
-                    assert len(ret) == 16
-                    ret = 'GetRandom:%s' % ret
-
-                elif cmd.startswith('EnCrypt?Pwd='):
-                    prefix = 'EnCrypt:'
-                    data = cmd.split('=', maxsplit=1)[1].encode('ascii')
-
-                    if not (6 <= len(data) <= 12):
-                        raise ServiceError(8009, 'Invalid password length (6 <= len <= 12)')
-
-                    with lock, connect_reader() as client:
-                        client.select_applet()
-                        card_id = client.get_hc_card_id().decode('ascii')
-
-                    encrypted = card_encrypt(data, card_id)
-                    ret = encrypted.hex().upper()
-
-                elif cmd.startswith('H_Sign?Random='):
-                    prefix = 'H_Sign:'
-                    data = cmd.split('=')[1].encode('ascii')
-                    assert len(data) == 20 and data[:4] == b'0001'
-                    sam_hc_auth_check(raise_on_failed=True)
-                    with lock, connect_reader() as client:
-                        sig = sam_hc_auth(client, data)
-                    ret = sig.decode('ascii')
-
-                elif cmd.startswith('SecureGetBasicWithParam?Pwd='):
-                    prefix = 'SecureGetBasicWithParam:'
-                    pwd = cmd.split('=', maxsplit=1)[0]
-                    ret = get_basic_data_encrypted(pwd)
-
-                else:
-                    ret = '9999'
-            except (SmartcardCommandException, ServiceError) as e:
-                if isinstance(e.error_code, (int, str)):
-                    prefix = ''
-                    result = '%d' % e.error_code
-                    logger.error('Error = {{{ %d: %s }}}' % (e.error_code, e.description))
-                else:
-                    result = '9876'
-                    logger.error('Error = {{{ Unexpected Error -> %r }}}' % e)
-            else:
-                result = prefix + ret
+        elif cmd == 'GetVersion':
+            ret = 'GetVersion:0001'
 
-            await ws.send(result)
+        elif cmd == 'GetBasic':
+            prefix = 'GetBasic:'
+            ret = get_basic_data(session)
 
-            result = censor_data(result, ':')
-            if len(result) >= 32:
-                result = '%s...(%d bytes)' % (result[:32], len(result) - 32)
-            logger.info('OutResult = {{{ %s }}}' % result)
+        elif cmd == 'GetRandom':
+            # pages ask for a random right before H_Sign
+            complicated_sam_hc_auth.warm_up('random')
+            rnd = int.from_bytes(os.urandom(8), 'little')
+            ret = str(rnd).zfill(16)[-16:]
+            assert len(ret) == 16
+            ret = 'GetRandom:%s' % ret
+
+        elif cmd.startswith('EnCrypt?Pwd='):
+            prefix = 'EnCrypt:'
+            data = cmd.split('=', maxsplit=1)[1].encode('ascii')
+
+            if not (6 <= len(data) <= 12):
+                raise ServiceError(8009, 'Invalid password length (6 <= len <= 12)')
+
+            with session.transaction() as client:
+                card_id = client.get_hc_card_id().decode('ascii')
+
+            encrypted = card_encrypt(data, card_id)
+            ret = encrypted.hex().upper()
+
+        elif cmd.startswith('H_Sign?Random='):
+            prefix = 'H_Sign:'
+            data = cmd.split('=')[1].encode('ascii')
+            assert len(data) == 20 and data[:4] == b'0001'
+            sam_hc_auth_check(raise_on_failed=True, max_age=SAM_CHECK_TTL)
+            sig = sam_hc_auth(session.get_client(), data)
+            ret = sig.decode('ascii')
+
+        elif cmd.startswith('SecureGetBasicWithParam?Pwd='):
+            prefix = 'SecureGetBasicWithParam:'
+            pwd = cmd.split('=', maxsplit=1)[0]
+            ret = get_basic_data_encrypted(session, pwd)
+
+        else:
+            ret = '9999'
+    except (SmartcardCommandException, ServiceError) as e:
+        return error_result(e)
+
+    return prefix + ret
+
+def rate_limited(owner, cmd):
+    """ Error result if `owner` ran out of tokens for `cmd`, else None """
+    if owner is None or limiter.allow(owner, ratelimit.command_cost(cmd)):
+        return None
+    return error_result(ServiceError(8429, 'Too many requests'))
+
+def error_result(e):
+    if isinstance(e.error_code, (int, str)):
+        logger.error('Error = {{{ %d: %s }}}', e.error_code, e.description)
+        return '%d' % e.error_code
+    else:
+        logger.error('Error = {{{ Unexpected Error -> %r }}}', e)
+        return '9876'
+
+def sign_batch(cmd, send, owner=None):
+    """
+        H_SignBatch?Random=<payload>,<payload>,...
+
+        Signs every payload with one SAM handshake and one card session, for
+        each payload `H_SignBatch:<index>:<signature>` or
+        `H_SignBatch:<index>:<error code>` is sent as soon as it completes.
+        Returns `H_SignBatch:Done:<signed>/<total>` or an error code if the
+        whole batch failed.
+    """
+    payloads = cmd.split('=', maxsplit=1)[1].split(',')
+    if not 0 < len(payloads) <= MAX_SIGN_BATCH_SIZE:
+        return error_result(ServiceError(8006, 'Invalid batch size'))
+
+    valid = []
+    for index, payload in enumerate(payloads):
+        if SIGN_PAYLOAD.fullmatch(payload):
+            valid.append(index)
+        else:
+            send('H_SignBatch:%d:%s' % (index, error_result(
+                ServiceError(8006, 'Invalid data `to_sign`'))))
+
+    signed = 0
+    if valid:
+        try:
+            sam_hc_auth_check(raise_on_failed=True, max_age=SAM_CHECK_TTL)
+            with CardSession(owner) as session:
+                items = sam_hc_auth_batch(session.get_client(),
+                                          [payloads[i].encode('ascii') for i in valid])
+                for i, sig, err in items:
+                    if err is None:
+                        signed += 1
+                        result = sig.decode('ascii')
+                    elif isinstance(err, (SmartcardCommandException, ServiceError)):
+                        result = error_result(err)
+                    else:
+                        logger.error('Error = {{{ Unexpected Error -> %r }}}', err)
+                        result = '9876'
+                    send('H_SignBatch:%d:%s' % (valid[i], result))
+        except (SmartcardCommandException, ServiceError) as e:
+            return error_result(e)
+
+    return 'H_SignBatch:Done:%d/%d' % (signed, len(payloads))
+
+def log_command(cmd):
+    # redaction and formatting happen in the logging thread
+    logger.info('InCmd = {{{ %s }}}', cmd, extra={'command': cmd})
+
+def log_result(cmd, result):
+    logger.info('OutResult = {{{ %s }}}', result,
+                extra={'command': cmd, 'splitter': ':', 'truncate': 32})
+
+def run_batch(message, owner=None):
+    """
+        Opt-in batch format, request:
+            {"batch": [{"id": "1", "cmd": "GetRandom"}, {"id": "2", "cmd": "GetBasic"}]}
+        response, in request order:
+            {"batch": [{"id": "1", "result": "GetRandom:..."}, {"id": "2", "result": "GetBasic:..."}]}
+        Card commands of a batch share one reader session and applet selection.
+    """
+    try:
+        items = json.loads(message)['batch']
+        if not isinstance(items, list) or not 0 < len(items) <= MAX_BATCH_SIZE:
+            raise ValueError('Invalid batch size')
+        commands = [(str(item.get('id', i)), item['cmd']) for i, item in enumerate(items)]
+        if not all(isinstance(cmd, str) for _, cmd in commands):
+            raise ValueError('Invalid command')
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.error('Error = {{{ Invalid batch -> %r }}}', e)
+        return '9999'
+
+    results = []
+    with CardSession(owner) as session:
+        for cmd_id, cmd in commands:
+            log_command(cmd)
+            result = rate_limited(owner, cmd) or run_command(cmd, session)
+            log_result(cmd, result)
+            results.append({'id': cmd_id, 'result': result})
+    return json.dumps({'batch': results})
+
+# card and SAM commands block, run them in threads so a shared event loop
+# (direct wss mode) keeps serving other connections
+command_executor = concurrent.futures.ThreadPoolExecutor(
+        COMMAND_WORKERS, thread_name_prefix='command')
+
+def close_idle(ws, loop):
+    # runs in the timer wheel thread, the connection (and the loop of a
+    # hijacked one) may have ended since the timer fired
+    if loop.is_closed():
+        return
+    close = ws.close(1001, 'idle')
+    try:
+        asyncio.run_coroutine_threadsafe(close, loop)
+    except RuntimeError:
+        # closed in between
+        close.close()
+        return
+    stats.incr('ws_idle_closed')
+
+async def handler(ws, path):
+    loop = asyncio.get_event_loop()
+    owner = (ws.origin, id(ws))
+    # websockets' own keepalive pings are disabled, idle connections are
+    # closed by the timer wheel instead
+    idle = None
+    if WS_IDLE_TIMEOUT:
+        idle = timerwheel.IdleTimer(WS_IDLE_TIMEOUT, functools.partial(close_idle, ws, loop))
+    try:
+        while True:
+            cmd = await ws.recv()
+            if idle:
+                idle.touch()
+
+            if cmd.startswith(BATCH_PREFIX):
+                # items are logged and rate limited one by one by run_batch
+                with tracing.span('command', command='batch'):
+                    result = await loop.run_in_executor(
+                            command_executor, tracing.wrap(run_batch, cmd, owner))
+                    with tracing.span('send'):
+                        await ws.send(result)
+                continue
+
+            log_command(cmd)
+            # only the command name, arguments may be personal data
+            with tracing.span('command', command=cmd.split('?', 1)[0]):
+                result = rate_limited(owner, cmd)
+                if result is None and cmd.startswith('H_SignBatch?Random='):
+                    def send(message):
+                        # called from the command thread for every signed payload
+                        asyncio.run_coroutine_threadsafe(ws.send(message), loop).result()
+                    result = await loop.run_in_executor(
+                            command_executor, tracing.wrap(sign_batch, cmd, send, owner))
+                elif result is None:
+                    result = await loop.run_in_executor(
+                            command_executor, tracing.wrap(run_command, cmd, None, owner))
+                with tracing.span('send'):
+                    await ws.send(result)
+            log_result(cmd, result)
     except websockets.ConnectionClosedOK:
         pass
     except websockets.ConnectionClosedError:
         pass
-
-ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-ssl_context.load_cert_chain('certs/chain.crt', 'certs/host.key')
+    except SystemExit:
+        # `Exit` closes this connection, it must not reach the event loop
+        # shared by every direct connection
+        await ws.close()
+    finally:
+        if idle:
+            idle.cancel()
+        limiter.forget(owner)
+
+def create_ssl_context():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain('certs/chain.crt', 'certs/host.key')
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+
+    if TLS_PROFILE == 'performance':
+        # AES-GCM runs on AES-NI, ChaCha20 is kept for CPUs without it
+        context.set_ciphers(PERFORMANCE_CIPHERS)
+        context.options |= ssl.OP_CIPHER_SERVER_PREFERENCE
+    if TLS_ECDH_CURVE:
+        context.set_ecdh_curve(TLS_ECDH_CURVE)
+
+    if TLS_SESSION_LIFETIME > 0:
+        # one ticket is enough, browsers reconnect one socket at a time
+        if hasattr(context, 'num_tickets'):
+            context.num_tickets = 1
+    else:
+        context.options |= ssl.OP_NO_TICKET
+        if hasattr(context, 'num_tickets'):
+            context.num_tickets = 0
+    return context
+
+ssl_context = None
+ssl_context_created = 0
+ssl_context_lock = threading.Lock()
+
+def get_ssl_context():
+    """
+        OpenSSL does not let us configure ticket lifetime from Python, instead
+        the context (with its ticket keys and session cache) is replaced once
+        it gets older than TLS_SESSION_LIFETIME, which invalidates sessions
+        issued by the previous one
+    """
+    global ssl_context, ssl_context_created
+    with ssl_context_lock:
+        now = time.monotonic()
+        if TLS_SESSION_LIFETIME <= 0:
+            # Python can't switch the TLS 1.2 session ID cache off, a fresh
+            # context per handshake has an empty one
+            ssl_context = create_ssl_context()
+            ssl_context_created = now
+            return ssl_context
+        if ssl_context is None or \
+                0 < TLS_SESSION_LIFETIME < now - ssl_context_created:
+            if ssl_context is not None:
+                stats.incr('tls_context_rotated')
+            ssl_context = create_ssl_context()
+            ssl_context_created = now
+        return ssl_context
+
+def tls_stats():
+    context = ssl_context
+    if context is None:
+        return {}
+    session = context.session_stats()
+    return {
+        'profile': TLS_PROFILE,
+        'session_lifetime': TLS_SESSION_LIFETIME,
+        'context_age': int(time.monotonic() - ssl_context_created),
+        'cache_hits': session['hits'],
+        'cache_misses': session['misses'],
+        'cache_timeouts': session['timeouts'],
+        'cached_sessions': session['number'],
+    }
+
+stats.register('tls', tls_stats)
+stats.register('startup', startup.report)
+stats.register('card_lock', lock.report)
+stats.register('rate_limit', limiter.report)
 
 import pysoxy
+import proxy_workers
 
 class PolyServer:
     def is_serving(self):
@@ -188,12 +587,147 @@ class PolyServer:
 def forwarder(sock):
     # this function will be executed in new thread,
     # we need to create a new event loop
+    threading.current_thread().name = 'forwarder-%d' % sock.fileno()
     event_loop = asyncio.new_event_loop()
 
     server = websockets.WebSocketServer(event_loop)
     server.wrap(PolyServer())
 
-    _, conn = event_loop.run_until_complete(event_loop.connect_accepted_socket(lambda: HTTP(handler, server, host='localhost', port=7777, secure=True), sock, ssl=ssl_context))
-    event_loop.run_until_complete(conn.wait_closed())
+    try:
+        # the handler task inherits the trace of the socks connection
+        with tracing.span('tls.handshake', activate=False):
+            _, conn = event_loop.run_until_complete(event_loop.connect_accepted_socket(lambda: HTTP(handler, server, host='localhost', port=7777, secure=True, ping_interval=None), sock, ssl=get_ssl_context()))
+        event_loop.run_until_complete(conn.wait_closed())
+    finally:
+        # an unclosed loop keeps its selector and self-pipe, 3 fds per connection
+        pending = asyncio.all_tasks(event_loop) if hasattr(asyncio, 'all_tasks') else asyncio.Task.all_tasks(event_loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            event_loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        event_loop.close()
+
+def create_direct_listener(addr, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((addr, port))
+    sock.listen(128)
+    sock.setblocking(False)
+    logger.info('[+] Direct wss server bind on %s:%d', *sock.getsockname())
+    return sock
+
+async def accept_direct(event_loop, server, sock):
+    # the SSL context is fetched per connection so it can be rotated
+    try:
+        with tracing.span('direct.connection', root=True), \
+                tracing.span('tls.handshake', activate=False):
+            await event_loop.connect_accepted_socket(
+                    lambda: HTTP(handler, server, host='localhost', port=DIRECT_WSS_PORT,
+                                 secure=True, ping_interval=None),
+                    sock, ssl=get_ssl_context())
+    except (OSError, asyncio.TimeoutError) as e:
+        logger.info('[-] Direct wss handshake failed: %r', e)
+        sock.close()
+
+async def serve_direct(listener):
+    event_loop = asyncio.get_event_loop()
+    server = websockets.WebSocketServer(event_loop)
+    server.wrap(PolyServer())
 
-pysoxy.main(forwarder, HOST)
+    while True:
+        sock, _ = await event_loop.sock_accept(listener)
+        event_loop.create_task(accept_direct(event_loop, server, sock))
+
+def run_direct_server(listener):
+    # one event loop serves every direct connection
+    event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(event_loop)
+    event_loop.run_until_complete(serve_direct(listener))
+
+def preload_modules():
+    with startup.phase('preload Cryptodome'):
+        basic_encrypt(b'')
+        card_encrypt(b'', '')
+
+    with startup.phase('preload cryptography'):
+        load_crypto_modules()
+
+    with startup.phase('preload pyscard'):
+        try:
+            import smartcard.System
+        except ImportError as e:
+            logger.error('Failed to load pyscard: %r', e)
+
+    startup.log_report(logger)
+
+def watch_card_insertion():
+    """ Warm up a SAM session when a card is inserted, signing usually follows """
+    try:
+        from smartcard.CardMonitoring import CardMonitor, CardObserver
+    except ImportError as e:
+        logger.error('Failed to load pyscard: %r', e)
+        return
+
+    class InsertionObserver(CardObserver):
+        def update(self, observable, actions):
+            added, removed = actions
+            if added:
+                complicated_sam_hc_auth.warm_up('card')
+
+    CardMonitor().addObserver(InsertionObserver())
+
+def on_proxy_ready():
+    startup.mark('socks listener')
+    if PRELOAD_MODULES:
+        threading.Thread(target=preload_modules, name='preload', daemon=True).start()
+    else:
+        startup.log_report(logger)
+    if SAM_WARM_UP and not REMOTE_READER:
+        threading.Thread(target=watch_card_insertion, name='card-monitor', daemon=True).start()
+
+worker_supervisor = None
+
+def traffic_report(n):
+    """ Top destinations of this process and the proxy workers """
+    tops = [traffic.top(traffic.TRAFFIC_TOP_CAPACITY)]
+    if worker_supervisor is not None:
+        tops.append(worker_supervisor.report()['traffic'])
+    return {'top': traffic.merge(*tops)[:n]}
+
+def main():
+    global worker_supervisor
+    tracing.setup()
+    flightrecorder.setup()
+    profiler.install_signal_handler()
+    get_ssl_context()
+    startup.mark('ssl context')
+
+    if PROXY_WORKERS and not proxy_workers.reuse_port_supported():
+        logger.error('[-] SO_REUSEPORT is not supported, PROXY_WORKERS ignored')
+        workers = 0
+    else:
+        workers = PROXY_WORKERS
+
+    if DIRECT_WSS_PORT or workers:
+        if DIRECT_WSS_PORT:
+            listener = create_direct_listener(DIRECT_WSS_ADDR, DIRECT_WSS_PORT)
+        else:
+            # only for relays from worker processes
+            listener = create_direct_listener('127.0.0.1', 0)
+        threading.Thread(target=run_direct_server, args=(listener, ),
+                         name='direct-wss', daemon=True).start()
+        startup.mark('direct wss listener')
+
+    if workers:
+        owner_addr, owner_port = listener.getsockname()
+        if owner_addr == '0.0.0.0':
+            owner_addr = '127.0.0.1'
+        pysoxy.REUSE_PORT = True
+        worker_supervisor = proxy_workers.start_workers(
+                workers, (owner_addr, owner_port), HOST)
+        startup.mark('proxy workers')
+
+    pysoxy.main(forwarder, HOST, on_ready=on_proxy_ready)
+
+if __name__ == '__main__':
+    main()
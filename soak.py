@@ -0,0 +1,320 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+#!/usr/bin/env python3
+"""
+ Soak test: runs the socks proxy and server.py in this process against
+ simulated cards (mockcard.py over remote_reader.py) and a simulated SAM
+ (mocksam.py), then drives connect / command / disconnect cycles the way a
+ browser does: socks5 CONNECT to iccert.nhi.gov.tw:7777, wss handshake,
+ GetRandom, GetBasic, H_Sign, close.
+
+ Memory is traced with tracemalloc, threads and file descriptors are
+ counted, growth is reported per 1000 connections against a baseline
+ taken after the warm up. The client side lives in the same process, but
+ keeps no state across cycles, so steady growth points at the agent.
+
+   python3 soak.py --duration 3600 --concurrency 4
+"""
+
+import argparse
+import asyncio
+import gc
+import os
+import random
+import socket
+import ssl
+import sys
+import threading
+import time
+import tracemalloc
+
+SOCKS_PORT = 17778
+ORIGIN = 'https://cloudicweb.nhi.gov.tw'
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_backends(cards):
+    """ Simulated SAM and readers, configured before server.py is imported """
+    sam_port = free_port()
+    os.environ['NIC_SMARTCARD_AUTH_HOST'] = '127.0.0.1'
+    os.environ['NIC_SMARTCARD_AUTH_PORT'] = str(sam_port)
+
+    # these import complicated_sam_hc_auth, which reads the address above
+    import mockcard
+    import mocksam
+    import remote_reader
+
+    mocksam.MockSamServer('127.0.0.1', sam_port).start()
+
+    readers = [('Mock Reader %d' % i, lambda i=i: mockcard.connect('Mock Reader %d' % i))
+               for i in range(cards)]
+    reader_port = free_port()
+    threading.Thread(target=remote_reader.RemoteReaderServer(readers).serve_forever,
+                     args=('127.0.0.1', reader_port), name='remote-reader',
+                     daemon=True).start()
+    os.environ['REMOTE_READER'] = '127.0.0.1:%d' % reader_port
+
+def start_agent(port):
+    # the limits would throttle the driver
+    os.environ.setdefault('RATE_LIMIT_ORIGIN', '0')
+    os.environ.setdefault('RATE_LIMIT_CONNECTION', '0')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    import pysoxy
+    import server
+
+    server.get_ssl_context()
+    pysoxy.LOCAL_PORT = port
+    ready = threading.Event()
+    threading.Thread(target=pysoxy.main, args=(server.forwarder, server.HOST, ready.set),
+                     name='socks-accept', daemon=True).start()
+    if not ready.wait(10):
+        raise RuntimeError('socks proxy did not start')
+    return server.HOST
+
+def socks_connect(port, host, dst_port=7777):
+    sock = socket.create_connection(('127.0.0.1', port), timeout=30)
+    # greeting and request in one write, the proxy reads them without a round trip
+    name = host.encode('ascii')
+    sock.sendall(b'\x05\x01\x00' +
+                 b'\x05\x01\x00\x03' + bytes([len(name)]) + name + dst_port.to_bytes(2, 'big'))
+    if recv_exact(sock, 2) != b'\x05\x00':
+        raise ConnectionError('socks greeting refused')
+    reply = recv_exact(sock, 10)
+    if reply[1] != 0:
+        raise ConnectionError('socks connect failed: %d' % reply[1])
+    sock.settimeout(None)
+    return sock
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        data += chunk
+    return data
+
+def fd_count():
+    for path in ('/proc/self/fd', '/dev/fd'):
+        if os.path.isdir(path):
+            return len(os.listdir(path))
+    return None
+
+class Driver:
+    def __init__(self, host, port, commands):
+        import websockets
+        self.websockets = websockets
+        self.host = host
+        self.port = port
+        self.commands = commands
+        self.ssl = ssl.create_default_context()
+        self.ssl.check_hostname = False
+        self.ssl.verify_mode = ssl.CERT_NONE
+        self.done = 0
+        self.failed = 0
+        self.stopped = False
+
+    async def cycle(self):
+        loop = asyncio.get_event_loop()
+        sock = await loop.run_in_executor(None, socks_connect, self.port, self.host)
+        ws = await self.websockets.connect(
+                'wss://%s:7777/echo' % self.host, sock=sock, ssl=self.ssl,
+                server_hostname=self.host, origin=ORIGIN, ping_interval=None)
+        try:
+            for cmd in self.commands:
+                if cmd == 'H_Sign':
+                    cmd = 'H_Sign?Random=0001%016d' % random.randrange(10 ** 16)
+                await ws.send(cmd)
+                result = await ws.recv()
+                if ':' not in result:
+                    raise RuntimeError('%s failed: %s' % (cmd, result))
+        finally:
+            await ws.close()
+
+    async def worker(self, limit):
+        while not self.stopped and (limit is None or self.done + self.failed < limit):
+            try:
+                await self.cycle()
+                self.done += 1
+            except Exception as e:
+                self.failed += 1
+                print('[-] Cycle failed: %r' % e, file=sys.stderr)
+
+    async def run(self, concurrency, limit):
+        await asyncio.gather(*(self.worker(limit) for _ in range(concurrency)))
+
+class Monitor:
+    def __init__(self, driver, top):
+        self.driver = driver
+        self.top = top
+        self.baseline = None
+        self.base_sample = None
+        self.started = time.monotonic()
+
+    def sample(self):
+        gc.collect()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        return snapshot, {
+            'connections': self.driver.done + self.driver.failed,
+            'completed': self.driver.done,
+            'memory': current,
+            'peak': peak,
+            'threads': threading.active_count(),
+            'fds': fd_count(),
+            'objects': len(gc.get_objects()),
+        }
+
+    def set_baseline(self):
+        self.baseline, self.base_sample = self.sample()
+        print('[*] Baseline after %(connections)d connections: %(memory)d bytes, '
+              '%(threads)d threads, %(fds)s fds, %(objects)d objects' % self.base_sample)
+
+    def growth(self, sample):
+        """ Growth per 1000 completed connections since the baseline """
+        conns = sample['completed'] - self.base_sample['completed']
+        if conns <= 0:
+            return None
+        result = {}
+        for name in ('memory', 'threads', 'fds', 'objects'):
+            if sample[name] is not None:
+                result[name] = (sample[name] - self.base_sample[name]) * 1000 / conns
+        return result
+
+    def report(self, final=False):
+        snapshot, sample = self.sample()
+        growth = self.growth(sample)
+        elapsed = time.monotonic() - self.started
+        print('[*] %d connections (%d failed) in %.0fs, %.1f/s: %d bytes traced, '
+              '%d threads, %s fds, %d objects' % (
+              sample['connections'], self.driver.failed, elapsed,
+              sample['connections'] / elapsed, sample['memory'],
+              sample['threads'], sample['fds'], sample['objects']))
+        if growth:
+            print('[*]   per 1000 completed connections: %s' % ', '.join(
+                  '%s %+.1f' % (name, value) for name, value in growth.items()))
+        if self.top and (final or growth):
+            for stat in snapshot.compare_to(self.baseline, 'lineno')[:self.top]:
+                print('[*]     %s' % stat)
+        sys.stdout.flush()
+        return growth
+
+def finish(code):
+    # the agent threads are daemons blocked in sockets, interpreter
+    # shutdown may abort on them
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+def main():
+    parser = argparse.ArgumentParser(description='Soak test the agent with simulated backends')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='seconds to run, the default is until interrupted')
+    parser.add_argument('--connections', type=int, default=None,
+                        help='stop after this many connections')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--cards', type=int, default=1, help='simulated readers')
+    parser.add_argument('--commands', default='GetRandom,GetBasic,H_Sign',
+                        help='commands sent on every connection')
+    parser.add_argument('--warmup', type=int, default=500,
+                        help='connections before the baseline snapshot, enough to fill '
+                             'the tracing ring')
+    parser.add_argument('--report-every', type=int, default=1000)
+    parser.add_argument('--top', type=int, default=10,
+                        help='allocation sites with the largest growth to show')
+    parser.add_argument('--frames', type=int, default=1,
+                        help='traceback depth recorded by tracemalloc')
+    parser.add_argument('--port', type=int, default=SOCKS_PORT, help='socks proxy port')
+    parser.add_argument('--max-memory-growth', type=float, default=None,
+                        help='exit with 1 if memory grows more bytes per 1000 connections')
+    parser.add_argument('--max-thread-growth', type=float, default=None)
+    parser.add_argument('--max-fd-growth', type=float, default=None)
+    parser.add_argument('--max-failures', type=float, default=0.01,
+                        help='exit with 1 if more than this fraction of cycles failed')
+    args = parser.parse_args()
+
+    start_backends(args.cards)
+    host = start_agent(args.port)
+    driver = Driver(host, args.port, args.commands.split(','))
+    monitor = Monitor(driver, args.top)
+
+    # trace the warm up too, so bounded buffers filled by it (the tracing
+    # ring, caches) are part of the baseline rather than growth
+    tracemalloc.start(args.frames)
+    loop = asyncio.get_event_loop()
+    print('[*] Warming up with %d connections' % args.warmup)
+    loop.run_until_complete(driver.run(args.concurrency, args.warmup))
+    if driver.done == 0:
+        print('[-] Every warm up cycle failed, is the agent broken?')
+        finish(1)
+    monitor.set_baseline()
+
+    limit = None if args.connections is None else driver.done + driver.failed + args.connections
+    deadline = None if args.duration is None else time.monotonic() + args.duration
+
+    async def supervise():
+        next_report = driver.done + driver.failed + args.report_every
+        while not driver.stopped:
+            await asyncio.sleep(0.5)
+            if deadline is not None and time.monotonic() >= deadline:
+                driver.stopped = True
+            if driver.done + driver.failed >= next_report:
+                next_report += args.report_every
+                # sampling blocks the loop, that only pauses the clients
+                monitor.report()
+
+    async def run():
+        task = loop.create_task(supervise())
+        try:
+            await driver.run(args.concurrency, limit)
+        finally:
+            driver.stopped = True
+            await task
+
+    try:
+        loop.run_until_complete(run())
+    except KeyboardInterrupt:
+        print('[*] Interrupted')
+
+    # let the agent finish closing the last connections
+    time.sleep(1)
+    growth = monitor.report(final=True) or {}
+    exceeded = [name for name, limit in (('memory', args.max_memory_growth),
+                                         ('threads', args.max_thread_growth),
+                                         ('fds', args.max_fd_growth))
+                if limit is not None and growth.get(name, 0) > limit]
+    if exceeded:
+        print('[-] Growth over the limit: %s' % ', '.join(exceeded))
+    # growth of a broken agent means nothing
+    total = driver.done + driver.failed
+    failed = driver.done == 0 or driver.failed > args.max_failures * total
+    if failed:
+        print('[-] %d of %d cycles failed' % (driver.failed, total))
+    if exceeded or failed:
+        finish(1)
+    print('[+] Done')
+    finish(0)
+
+if __name__ == '__main__':
+    main()
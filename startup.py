@@ -0,0 +1,64 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""
+ Startup phase timing
+
+ Import this module first, `mark` records the main thread phase which ended
+ since the previous mark, `phase` times background work.
+"""
+
+import contextlib
+import threading
+import time
+
+T0 = time.perf_counter()
+
+_lock = threading.Lock()
+_last_mark = T0
+_phases = []
+
+def _record(name, start, end):
+    with _lock:
+        _phases.append({
+            'phase': name,
+            'thread': threading.current_thread().name,
+            'start_ms': round((start - T0) * 1000, 1),
+            'duration_ms': round((end - start) * 1000, 1),
+        })
+
+def mark(name):
+    global _last_mark
+    now = time.perf_counter()
+    start, _last_mark = _last_mark, now
+    _record(name, start, now)
+
+@contextlib.contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, start, time.perf_counter())
+
+def report():
+    with _lock:
+        return sorted(_phases, key=lambda p: p['start_ms'])
+
+def log_report(logger):
+    for p in report():
+        logger.info('[*] Startup %-24s +%7.1f ms  %7.1f ms  (%s)',
+                    p['phase'], p['start_ms'], p['duration_ms'], p['thread'])
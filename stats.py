@@ -0,0 +1,48 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""
+ Process wide counters of the agent
+
+ Modules count events with `incr`, values which are cheaper to compute on
+ demand are provided by callbacks registered with `register`.
+"""
+
+import threading
+from collections import Counter
+
+_lock = threading.Lock()
+_counters = Counter()
+_providers = {}
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+def register(name, provider):
+    """ `provider` is called on every snapshot and returns a dict """
+    _providers[name] = provider
+
+def snapshot():
+    with _lock:
+        result = dict(_counters)
+
+    for name, provider in list(_providers.items()):
+        try:
+            result[name] = provider()
+        except Exception as e:
+            result[name] = {'error': repr(e)}
+    return result
@@ -0,0 +1,47 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hccard import HealthInsuranceSmartcardClient, SmartcardCommandException
+
+class FailingConnection:
+    """ Answers 6A82 to the APDU with P1 `p1` """
+    def __init__(self, p1):
+        self.p1 = p1
+
+    def transmit(self, cmd):
+        if cmd[2] == self.p1:
+            return [], 0x6a, 0x82
+        return [0] * 64, 0x90, 0x00
+
+class BasicAndCardDataTest(unittest.TestCase):
+    def read(self, p1):
+        client = HealthInsuranceSmartcardClient(FailingConnection(p1))
+        with self.assertRaises(SmartcardCommandException) as cm:
+            client.get_basic_and_card_data()
+        return cm.exception.error_code
+
+    def test_error_code_per_stage(self):
+        self.assertEqual(self.read(0x11), 8011)
+        self.assertEqual(self.read(0x24), 8010)
+
+if __name__ == '__main__':
+    unittest.main()
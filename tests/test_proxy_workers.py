@@ -0,0 +1,103 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import proxy_workers
+from proxy_workers import WorkerSupervisor, MAX_FAILURES, RESTART_BACKOFF_MAX, STABLE_TIME
+
+class DeadProcess:
+    pid = 1
+
+    def __init__(self, alive=False):
+        self.alive = alive
+
+    def is_alive(self):
+        return self.alive
+
+    def terminate(self):
+        self.alive = False
+
+    def join(self, timeout=None):
+        pass
+
+TICK = 0.5
+
+class FakeSupervisor(WorkerSupervisor):
+    """ Spawns processes which die at once unless `alive`, the clock is `now` """
+    def __init__(self):
+        self.count = 1
+        self.status_queue = None
+        self.workers = {}
+        self.last_seen = {}
+        self.snapshots = {}
+        self.restarts = {0: 0}
+        self.failures = {0: 0}
+        self.started = {}
+        self.restart_at = {}
+        self.given_up = set()
+        self.lock = mock.MagicMock()
+        self.now = 0.0
+        self.spawned = []
+        self.alive = False
+
+    def spawn(self, index):
+        self.spawned.append(self.now)
+        self.workers[index] = DeadProcess(self.alive)
+        self.last_seen[index] = self.started[index] = self.now
+
+    def run(self, seconds):
+        end = self.now + seconds
+        with mock.patch.object(proxy_workers.time, 'monotonic', lambda: self.now):
+            while self.now < end:
+                self.check()
+                self.now += TICK
+
+class WorkerSupervisorTest(unittest.TestCase):
+    def test_restarts_back_off(self):
+        supervisor = FakeSupervisor()
+        supervisor.spawn(0)
+        supervisor.run(20)
+        delays = [b - a for a, b in zip(supervisor.spawned, supervisor.spawned[1:])]
+        # restarted workers are found dead on the next tick
+        self.assertEqual(delays[:4], [1, 2 + TICK, 4 + TICK, 8 + TICK])
+
+    def test_gives_up(self):
+        supervisor = FakeSupervisor()
+        supervisor.spawn(0)
+        supervisor.run(MAX_FAILURES * RESTART_BACKOFF_MAX)
+        self.assertEqual(len(supervisor.spawned), MAX_FAILURES)
+        self.assertIn(0, supervisor.given_up)
+        self.assertEqual(supervisor.report()['workers'][0]['restarts'], MAX_FAILURES - 1)
+
+    def test_stable_worker_resets_failures(self):
+        supervisor = FakeSupervisor()
+        supervisor.spawn(0)
+        supervisor.run(1)
+        self.assertEqual(supervisor.failures[0], 1)
+        supervisor.alive = True
+        supervisor.run(2)
+        supervisor.last_seen[0] = supervisor.now + STABLE_TIME
+        supervisor.run(STABLE_TIME)
+        self.assertEqual(supervisor.failures[0], 0)
+
+if __name__ == '__main__':
+    unittest.main()
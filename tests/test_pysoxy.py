@@ -0,0 +1,87 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pysoxy
+from pysoxy import read_message, parse_greeting, parse_request, \
+        AddressTypeError, CMD_CONNECT
+
+GREETING = b'\x05\x01\x00'
+DOMAIN_REQUEST = b'\x05\x01\x00\x03\x11iccert.nhi.gov.tw\x1e\x61'
+
+class ParseTest(unittest.TestCase):
+    def test_greeting(self):
+        self.assertIsNone(parse_greeting(b'\x05'))
+        self.assertIsNone(parse_greeting(b'\x05\x02\x00'))
+        self.assertEqual(parse_greeting(GREETING + b'rest'), (b'\x00', 3))
+        with self.assertRaises(ValueError):
+            parse_greeting(b'\x04\x01\x00')
+
+    def test_request_addresses(self):
+        self.assertEqual(parse_request(DOMAIN_REQUEST + b'early'),
+                         ((CMD_CONNECT, b'iccert.nhi.gov.tw', 7777), len(DOMAIN_REQUEST)))
+        ipv4 = b'\x05\x01\x00\x01\x7f\x00\x00\x01\x00\x50'
+        self.assertEqual(parse_request(ipv4), ((CMD_CONNECT, '127.0.0.1', 80), 10))
+        ipv6 = b'\x05\x01\x00\x04' + socket.inet_pton(socket.AF_INET6, '::1') + b'\x01\xbb'
+        self.assertEqual(parse_request(ipv6), ((CMD_CONNECT, '::1', 443), 22))
+        self.assertIsNone(parse_request(DOMAIN_REQUEST[:-1]))
+        with self.assertRaises(AddressTypeError):
+            parse_request(b'\x05\x01\x00\x05\x00\x00')
+
+class ReadMessageTest(unittest.TestCase):
+    def setUp(self):
+        self.server, self.client = socket.socketpair()
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+    def test_pipelined_messages_leave_early_data(self):
+        self.client.sendall(GREETING + DOMAIN_REQUEST + b'early')
+        self.assertEqual(read_message(self.server, parse_greeting), b'\x00')
+        self.assertEqual(read_message(self.server, parse_request)[1], b'iccert.nhi.gov.tw')
+        self.assertEqual(self.server.recv(100), b'early')
+
+    def test_split_message(self):
+        def send():
+            for i in range(len(DOMAIN_REQUEST)):
+                self.client.sendall(DOMAIN_REQUEST[i:i + 1])
+                time.sleep(0.001)
+            self.client.sendall(b'early')
+        threading.Thread(target=send).start()
+        self.assertEqual(read_message(self.server, parse_request)[2], 7777)
+        self.assertEqual(self.server.recv(5, socket.MSG_WAITALL), b'early')
+
+    def test_eof(self):
+        self.client.sendall(DOMAIN_REQUEST[:5])
+        self.client.shutdown(socket.SHUT_WR)
+        self.assertIsNone(read_message(self.server, parse_request))
+
+class ConnectTest(unittest.TestCase):
+    def test_malformed_domain(self):
+        for name in (b'\xff.com', b'xn--zz.com'):
+            self.assertEqual(pysoxy.connect_to_dst(name, 80), 0)
+
+if __name__ == '__main__':
+    unittest.main()
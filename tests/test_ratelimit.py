@@ -0,0 +1,55 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ratelimit import RateLimiter, command_cost
+
+# server.MAX_SIGN_BATCH_SIZE
+MAX_SIGN_BATCH_SIZE = 64
+OWNER = ('https://cloudicweb.nhi.gov.tw', 1)
+
+def sign_batch(size):
+    return 'H_SignBatch?Random=' + ','.join(['0001%016d' % i for i in range(size)])
+
+class RateLimiterTest(unittest.TestCase):
+    def test_batch_cost(self):
+        self.assertEqual(command_cost(sign_batch(MAX_SIGN_BATCH_SIZE)), MAX_SIGN_BATCH_SIZE)
+        self.assertEqual(command_cost('GetRandom'), 0)
+
+    def test_full_batch_with_default_limits(self):
+        for size in (11, 20, MAX_SIGN_BATCH_SIZE):
+            limiter = RateLimiter()
+            self.assertTrue(limiter.allow(OWNER, command_cost(sign_batch(size))), size)
+
+    def test_oversized_request_leaves_debt(self):
+        limiter = RateLimiter()
+        self.assertTrue(limiter.allow(OWNER, MAX_SIGN_BATCH_SIZE))
+        self.assertFalse(limiter.allow(OWNER, 1))
+        # another connection of the same origin pays the origin debt too
+        self.assertFalse(limiter.allow((OWNER[0], 2), 1))
+
+    def test_burst(self):
+        limiter = RateLimiter(connection_rate=1, connection_burst=3, origin_rate=0)
+        self.assertTrue(all(limiter.allow(OWNER) for _ in range(3)))
+        self.assertFalse(limiter.allow(OWNER))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import queue
+import socket
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mockcard
+from remote_reader import ReaderWorker, Request, RemoteReaderServer, RemoteReaderPool, \
+        RemoteReaderError, OP_BEGIN, OP_END, OP_TRANSMIT, OP_CLOSE, STATUS_OK
+
+GET_RANDOM = bytes([0, 0x84, 0, 0, 8])
+
+class FakeSession:
+    def __init__(self, name):
+        self.name = name
+        self.closed = False
+        self.replies = queue.Queue()
+
+    def reply(self, request_id, status, payload=b''):
+        self.replies.put((request_id, status, payload))
+
+    def wait(self, request_id):
+        got = self.replies.get(timeout=2)
+        assert got[0] == request_id, got
+        return got
+
+class ReaderWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.worker = ReaderWorker('test', mockcard.connect)
+        self.worker.start()
+
+    def send(self, session, request_id, op, payload=b''):
+        self.worker.put(Request(session, request_id, op, payload))
+
+    def close(self, session):
+        session.closed = True
+        self.send(session, 0, OP_CLOSE)
+
+    def test_waiter_disconnecting_does_not_own_reader(self):
+        a, b, c = FakeSession('a'), FakeSession('b'), FakeSession('c')
+        self.send(a, 1, OP_BEGIN)
+        self.assertEqual(a.wait(1)[1], STATUS_OK)
+
+        # b queues behind a's transaction and goes away
+        self.send(b, 1, OP_BEGIN)
+        self.close(b)
+
+        self.send(a, 2, OP_END)
+        self.assertEqual(a.wait(2)[1], STATUS_OK)
+        self.close(a)
+
+        self.send(c, 1, OP_TRANSMIT, GET_RANDOM)
+        self.assertEqual(c.wait(1)[1], STATUS_OK)
+        self.assertIsNone(self.worker.owner)
+        self.assertTrue(b.replies.empty())
+
+    def test_requests_wait_for_transaction(self):
+        a, b = FakeSession('a'), FakeSession('b')
+        self.send(a, 1, OP_BEGIN)
+        a.wait(1)
+        self.send(b, 1, OP_TRANSMIT, GET_RANDOM)
+        self.send(a, 2, OP_TRANSMIT, GET_RANDOM)
+        a.wait(2)
+        self.assertTrue(b.replies.empty())
+        self.send(a, 3, OP_END)
+        a.wait(3)
+        self.assertEqual(b.wait(1)[1], STATUS_OK)
+
+class RemoteReaderPoolTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            cls.port = s.getsockname()[1]
+        server = RemoteReaderServer([('Mock Reader 0', mockcard.connect)], token='')
+        threading.Thread(target=server.serve_forever, args=('127.0.0.1', cls.port),
+                         daemon=True).start()
+
+    def setUp(self):
+        self.pool = None
+        for _ in range(50):
+            try:
+                self.pool = RemoteReaderPool('127.0.0.1', self.port, token='')
+                self.pool.release(self.pool.acquire())
+                break
+            except OSError:
+                threading.Event().wait(0.1)
+
+    def kill(self, conn):
+        """ Swap the socket for one the peer already closed """
+        dead, peer = socket.socketpair()
+        peer.close()
+        conn.sock.close()
+        conn.sock = dead
+
+    def test_dead_pooled_connection_is_replaced(self):
+        conn = self.pool.acquire()
+        self.kill(conn)
+        dead = conn.sock
+        self.pool.release(conn)
+
+        self.assertIs(self.pool.acquire(), conn)
+        # answered, by the card behind a fresh connection
+        conn.transmit(GET_RANDOM)
+        self.assertIsNot(conn.sock, dead)
+        conn.disconnect()
+
+    def test_dead_connection_fails_once_used(self):
+        conn = self.pool.acquire()
+        conn.transmit(GET_RANDOM)
+        self.kill(conn)
+        with self.assertRaises(RemoteReaderError):
+            conn.transmit(GET_RANDOM)
+
+if __name__ == '__main__':
+    unittest.main()
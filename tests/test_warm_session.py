@@ -0,0 +1,81 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import complicated_sam_hc_auth
+from complicated_sam_hc_auth import WarmSession
+
+class FakeConn:
+    def __init__(self):
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+class WarmSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.conns = []
+        def connect():
+            self.conns.append(FakeConn())
+            return self.conns[-1]
+        for name, value in (('sam_hc_auth_check', lambda **kwargs: True),
+                            ('connect', connect),
+                            ('handshake', lambda conn: b'k' * 24)):
+            patcher = mock.patch.object(complicated_sam_hc_auth, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def wait_ready(self, warm):
+        deadline = time.monotonic() + 5
+        while warm.session is None:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_unused_session_expires(self):
+        warm = WarmSession(idle=0.1)
+        warm.warm_up('test')
+        self.wait_ready(warm)
+        self.assertTrue(self.conns[0].closed.wait(5))
+        self.assertIsNone(warm.take())
+
+    def test_session_after_take_expires(self):
+        warm = WarmSession(idle=0.1)
+        warm.warm_up('test')
+        self.wait_ready(warm)
+        conn, _ = warm.take()
+        self.assertIs(conn, self.conns[0])
+
+        # the next session must not see the first one being taken
+        warm.warm_up('test')
+        self.wait_ready(warm)
+        self.assertTrue(self.conns[1].closed.wait(5))
+        self.assertFalse(self.conns[0].closed.is_set())
+        self.assertIsNone(warm.session)
+
+        warm.warm_up('test')
+        self.wait_ready(warm)
+        self.assertEqual(len(self.conns), 3)
+
+if __name__ == '__main__':
+    unittest.main()
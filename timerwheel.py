@@ -0,0 +1,151 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""
+ Hashed timer wheel for idle timeouts and deadlines
+
+ One thread advances the wheel every TICK seconds, scheduling and
+ cancelling are O(1). Connections don't wake up to check their own
+ timeouts: an `IdleTimer` only records the time of the last activity and
+ is checked when its slot comes around. Callbacks run in the wheel thread
+ and must not block, typically they shut a socket down so the thread
+ blocked on it returns.
+"""
+
+import logging
+import math
+import threading
+import time
+
+import stats
+
+logger = logging.getLogger('timerwheel')
+
+TICK = 0.5
+SLOTS = 512
+
+class Timer:
+    __slots__ = ('callback', 'slot', 'rounds', 'wheel')
+
+    def __init__(self, wheel, callback):
+        self.wheel = wheel
+        self.callback = callback
+        self.slot = None
+        self.rounds = 0
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+class TimerWheel:
+    def __init__(self, tick=TICK, slots=SLOTS):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.cursor = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def schedule(self, delay, callback):
+        """ Call `callback()` after `delay` seconds, rounded up to a tick """
+        ticks = max(1, math.ceil(delay / self.tick))
+        timer = Timer(self, callback)
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='timer-wheel', daemon=True)
+                self.thread.start()
+            timer.slot = (self.cursor + ticks) % len(self.slots)
+            timer.rounds = (ticks - 1) // len(self.slots)
+            self.slots[timer.slot].add(timer)
+            self.pending += 1
+        return timer
+
+    def cancel(self, timer):
+        with self.lock:
+            if timer.slot is not None and timer in self.slots[timer.slot]:
+                self.slots[timer.slot].discard(timer)
+                self.pending -= 1
+            timer.slot = None
+
+    def advance(self):
+        expired = []
+        with self.lock:
+            self.cursor = (self.cursor + 1) % len(self.slots)
+            slot = self.slots[self.cursor]
+            for timer in list(slot):
+                if timer.rounds:
+                    timer.rounds -= 1
+                else:
+                    slot.discard(timer)
+                    timer.slot = None
+                    expired.append(timer)
+            self.pending -= len(expired)
+
+        for timer in expired:
+            try:
+                timer.callback()
+            except Exception:
+                logger.exception('[-] Timer callback failed')
+
+    def run(self):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_tick += self.tick
+            self.advance()
+
+    def report(self):
+        return {'pending': self.pending, 'tick': self.tick, 'slots': len(self.slots)}
+
+class IdleTimer:
+    """
+        Calls `on_idle()` once nothing called `touch` for `timeout` seconds.
+        `touch` only stores a timestamp, the timer is rescheduled lazily.
+    """
+    def __init__(self, timeout, on_idle, wheel=None):
+        self.wheel = wheel or default_wheel
+        self.timeout = timeout
+        self.on_idle = on_idle
+        self.last_activity = time.monotonic()
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.timer = self.wheel.schedule(timeout, self.check)
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def check(self):
+        remaining = self.timeout - (time.monotonic() - self.last_activity)
+        with self.lock:
+            if self.cancelled:
+                return
+            if remaining > self.wheel.tick:
+                self.timer = self.wheel.schedule(remaining, self.check)
+                return
+            self.cancelled = True
+        self.on_idle()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            self.timer.cancel()
+
+default_wheel = TimerWheel()
+stats.register('timers', default_wheel.report)
+
+def schedule(delay, callback):
+    return default_wheel.schedule(delay, callback)
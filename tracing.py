@@ -0,0 +1,207 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""
+ Lightweight span tracing
+
+ A trace starts at the accepted proxy (or direct wss) socket and the
+ current span travels in a context variable: through the forwarder thread,
+ into the asyncio tasks of its event loop, and into command threads when
+ the work is submitted with `wrap`. Finished spans go to an in-memory ring
+ and, if TRACE_FILE is set, are appended to that file as JSON lines.
+
+ Without contextvars (Python 3.6) tracing is disabled.
+"""
+
+import collections
+import contextlib
+import functools
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+logger = logging.getLogger('tracing')
+
+TRACE_FILE = os.getenv('TRACE_FILE', '')
+TRACE_BUFFER = int(os.getenv('TRACE_BUFFER', 4096))
+ENABLED = contextvars is not None and TRACE_BUFFER > 0
+
+_span_ids = itertools.count(1)
+_finished = collections.deque(maxlen=max(TRACE_BUFFER, 1))
+_lock = threading.Lock()
+_listeners = []
+_current = contextvars.ContextVar('span', default=None) if contextvars else None
+
+class Span:
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attrs',
+                 'start', 'wall', 'duration', 'thread')
+
+    def __init__(self, name, parent=None, attrs=None):
+        self.trace_id = parent.trace_id if parent else os.urandom(8).hex()
+        self.span_id = next(_span_ids)
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.attrs = attrs or {}
+        self.start = time.perf_counter()
+        self.wall = time.time()
+        self.duration = None
+        self.thread = threading.current_thread().name
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+        export(self)
+
+    def to_dict(self):
+        return {
+            'trace': self.trace_id,
+            'span': self.span_id,
+            'parent': self.parent_id,
+            'name': self.name,
+            'ts': round(self.wall, 6),
+            'ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+            'thread': self.thread,
+            'attrs': self.attrs,
+        }
+
+def current_span():
+    return _current.get() if ENABLED else None
+
+def current_trace_id():
+    span = current_span()
+    return span.trace_id if span else None
+
+@contextlib.contextmanager
+def span(name, root=False, activate=True, **attrs):
+    """
+        Time the block as a child of the current span, `root` starts a new
+        trace. With `activate=False` the span does not become the parent of
+        spans (and tasks) created inside the block.
+    """
+    if not ENABLED:
+        yield None
+        return
+
+    s = Span(name, None if root else _current.get(), attrs)
+    token = _current.set(s) if activate else None
+    try:
+        yield s
+    except BaseException as e:
+        s.attrs['error'] = type(e).__name__
+        raise
+    finally:
+        if token is not None:
+            _current.reset(token)
+        s.finish()
+
+def traced(name):
+    """ Decorator, time every call of the function as a span """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def wrap(fn, *args):
+    """ Run `fn(*args)` in a copy of the current context, for executors """
+    if not ENABLED:
+        return functools.partial(fn, *args)
+    return functools.partial(contextvars.copy_context().run, fn, *args)
+
+def export(s):
+    with _lock:
+        _finished.append(s)
+    for listener in _listeners:
+        listener(s)
+
+def add_listener(listener):
+    """ `listener(span)` is called in the thread which finished the span """
+    _listeners.append(listener)
+
+def spans(trace_id=None):
+    with _lock:
+        items = list(_finished)
+    if trace_id is not None:
+        items = [s for s in items if s.trace_id == trace_id]
+    return items
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def breakdown():
+    """ Duration per span name over the spans in memory, in ms """
+    durations = collections.defaultdict(list)
+    for s in spans():
+        durations[s.name].append(s.duration * 1000)
+
+    result = {}
+    for name, values in sorted(durations.items()):
+        values.sort()
+        result[name] = {
+            'count': len(values),
+            'avg': round(sum(values) / len(values), 3),
+            'p50': round(percentile(values, 0.5), 3),
+            'p99': round(percentile(values, 0.99), 3),
+            'max': round(values[-1], 3),
+        }
+    return result
+
+def report(trace_id=None):
+    if trace_id:
+        return {'trace': trace_id, 'spans': [s.to_dict() for s in spans(trace_id)]}
+    return {'stages': breakdown()}
+
+class FileExporter(threading.Thread):
+    """ Append spans to a JSONL file from a background thread """
+    def __init__(self, path, maxsize=10000):
+        super().__init__(name='trace-exporter', daemon=True)
+        self.path = path
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+
+    def __call__(self, s):
+        try:
+            self.queue.put_nowait(s.to_dict())
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            while True:
+                item = self.queue.get()
+                f.write(json.dumps(item) + '\n')
+                if self.queue.empty():
+                    f.flush()
+
+def setup(path=TRACE_FILE):
+    if not ENABLED:
+        logger.info('[*] Tracing is disabled')
+        return
+    if path:
+        exporter = FileExporter(path)
+        exporter.start()
+        add_listener(exporter)
+        logger.info('[*] Tracing spans to %s', path)
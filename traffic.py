@@ -0,0 +1,130 @@
+# This file is part of twnhi-smartcard-agent.
+#
+# twnhi-smartcard-agent is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# twnhi-smartcard-agent is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with twnhi-smartcard-agent.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""
+ Per-destination traffic accounting of proxied tunnels
+
+ Tunnels count bytes in local variables and report once when they close.
+ Destinations are kept in a Space-Saving sketch weighted by bytes: memory
+ is bounded by TRAFFIC_TOP_CAPACITY entries, every destination moving more
+ than total / capacity bytes is guaranteed to be tracked, and its byte
+ count is overestimated by at most `error`.
+"""
+
+import heapq
+import os
+import threading
+
+import stats
+
+TRAFFIC_TOP_CAPACITY = int(os.getenv('TRAFFIC_TOP_CAPACITY', 256))
+# entries reported with the stats snapshot, proxy workers send it with
+# their heartbeat
+TRAFFIC_STATS_TOP = 32
+
+class Entry:
+    __slots__ = ('bytes', 'error', 'bytes_up', 'bytes_down', 'connections', 'duration')
+
+    def __init__(self, error=0):
+        self.bytes = error
+        self.error = error
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.connections = 0
+        self.duration = 0.0
+
+class SpaceSaving:
+    """
+        `heap` has one (bytes, key) item per entry, the bytes it had when
+        pushed. Counts only grow, so a stale item is never above its true
+        count: hits don't touch the heap, an eviction refreshes stale items
+        at the top until the top is exact, that's the smallest entry.
+    """
+    def __init__(self, capacity=TRAFFIC_TOP_CAPACITY):
+        self.capacity = capacity
+        self.entries = {}
+        self.heap = []
+        self.lock = threading.Lock()
+
+    def evict(self):
+        while True:
+            count, key = self.heap[0]
+            current = self.entries[key].bytes
+            if current == count:
+                return key
+            heapq.heapreplace(self.heap, (current, key))
+
+    def add(self, key, up, down, duration):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                if len(self.entries) < self.capacity:
+                    entry = Entry()
+                    heapq.heappush(self.heap, (0, key))
+                else:
+                    # the new key inherits the count of the smallest entry
+                    # as its possible error
+                    victim = self.evict()
+                    entry = Entry(self.entries.pop(victim).bytes)
+                    heapq.heapreplace(self.heap, (entry.bytes, key))
+                    stats.incr('traffic_evicted')
+                self.entries[key] = entry
+            entry.bytes += up + down
+            entry.bytes_up += up
+            entry.bytes_down += down
+            entry.connections += 1
+            entry.duration += duration
+
+    def top(self, n):
+        with self.lock:
+            items = sorted(self.entries.items(), key=lambda kv: kv[1].bytes, reverse=True)[:n]
+            return [{
+                'destination': key,
+                'bytes': e.bytes,
+                'error': e.error,
+                'bytes_up': e.bytes_up,
+                'bytes_down': e.bytes_down,
+                'connections': e.connections,
+                'duration': round(e.duration, 3),
+            } for key, e in items]
+
+sketch = SpaceSaving()
+
+def record(destination, up, down, duration):
+    """ Called once per tunnel when it closes """
+    sketch.add(destination, up, down, duration)
+    stats.incr('traffic_bytes_up', up)
+    stats.incr('traffic_bytes_down', down)
+    stats.incr('traffic_tunnels')
+
+def merge(*tops):
+    """ Combine top lists of several processes, sums are still upper bounds """
+    merged = {}
+    for items in tops:
+        for item in items:
+            total = merged.setdefault(item['destination'], dict.fromkeys(item, 0))
+            for name, value in item.items():
+                if name != 'destination':
+                    total[name] += value
+            total['destination'] = item['destination']
+    for item in merged.values():
+        item['duration'] = round(item['duration'], 3)
+    return sorted(merged.values(), key=lambda item: item['bytes'], reverse=True)
+
+def top(n=20):
+    return sketch.top(n)
+
+stats.register('traffic', lambda: sketch.top(TRAFFIC_STATS_TOP))